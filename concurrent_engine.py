@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent front end of the matching engine
+
+Orders can be submitted from any number of threads. Symbols are spread over a
+pool of matching threads, each owning a MatchingEngine with the books of its
+symbols, so no book is ever touched by two threads. The events are numbered per
+symbol by the thread owning it and handed to the subscribers by a single
+publisher thread, in the order of each symbol.
+"""
+
+import queue
+import threading
+import zlib
+from collections import namedtuple
+
+import pandas as pd
+
+from matching_engine import (
+    AckEvent,
+    FillEvent,
+    MatchingEngine,
+    RejectEvent,
+    SweepEvent,
+)
+from order_ids import OrderIdIndex
+
+# seq counts the events of the symbol from 0, in the order of its submissions
+SequencedEvent = namedtuple("SequencedEvent", "symbol seq event")
+
+
+class ConcurrentEngine:
+    """
+    Thread-safe order submission over a pool of matching threads
+    """
+
+    def __init__(self, threads: int = 4, reject_duplicates: bool = True, **options):
+        """
+
+        Parameters
+        ----------
+        threads : int, optional
+            number of matching threads. The default is 4.
+        reject_duplicates : bool, optional
+            reject the orders reusing the OrderID of an accepted order whatever
+            their symbol, like MatchingEngine. The index is shared by the matching
+            threads, between two threads the first one accepting the id wins.
+            The default is True.
+        **options :
+            keyword arguments of the MatchingEngine of each thread (text_logs
+            excepted, add a CsvLogger with add_sink instead). A risk.PreTradeRisk
+            can be shared, its states are per symbol.
+
+        Returns
+        -------
+        None.
+
+        """
+        if threads <= 0:
+            raise Exception("threads must be strictly positive")
+        self.callbacks = []
+        self.order_ids = OrderIdIndex() if reject_duplicates else None
+        self.order_ids_lock = threading.Lock()
+        self.events = queue.Queue()
+        self.errors = []
+        self.workers = []
+        for _ in range(threads):
+            engine = MatchingEngine(text_logs=False, reject_duplicates=False, **options)
+            engine.order_ids = self.order_ids
+            engine.order_ids_lock = self.order_ids_lock
+            worker = {
+                "engine": engine,
+                "orders": queue.Queue(),
+                "seqs": {},  # symbol -> next sequence number, only used by the thread
+            }
+            for register in (
+                engine.on_ack,
+                engine.on_reject,
+                engine.on_fill,
+                engine.on_sweep,
+            ):
+                register(lambda event, seqs=worker["seqs"]: self.sequence(seqs, event))
+            worker["thread"] = threading.Thread(
+                target=self.match, args=(worker,), daemon=True
+            )
+            self.workers.append(worker)
+        self.publisher = threading.Thread(target=self.publish, daemon=True)
+        self.publisher.start()
+        for worker in self.workers:
+            worker["thread"].start()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def on_event(self, callback):
+        """
+        Register a callback receiving a SequencedEvent for every ack, reject, fill
+        and sweep, always called from the publisher thread
+
+        Parameters
+        ----------
+        callback : callable
+
+        Returns
+        -------
+        None.
+
+        """
+        self.callbacks.append(callback)
+
+    def add_sink(self, sink):
+        """
+        Register the ack, reject and fill methods of a sink (and sweep if it has
+        one), e.g. a matching_engine.CsvLogger. They are only called from the
+        publisher thread so the sink needs no locking.
+
+        Parameters
+        ----------
+        sink : event sink
+
+        Returns
+        -------
+        None.
+
+        """
+        methods = {
+            AckEvent: sink.ack,
+            RejectEvent: sink.reject,
+            FillEvent: sink.fill,
+            SweepEvent: getattr(sink, "sweep", None),
+        }
+
+        def dispatch(sequenced):
+            method = methods[type(sequenced.event)]
+            if method is not None:
+                method(sequenced.event)
+
+        self.on_event(dispatch)
+
+    def worker_of(self, symbol) -> dict:
+        """
+        Matching thread owning a symbol, the same for every run
+
+        Parameters
+        ----------
+        symbol : str
+
+        Returns
+        -------
+        dict
+
+        """
+        return self.workers[zlib.crc32(str(symbol).encode()) % len(self.workers)]
+
+    def submit(self, order_id, symbol, price, side, quantity):
+        """
+        Queue an order for the thread owning its symbol, safe from any thread.
+        The orders of a symbol are matched in the order of their submissions.
+
+        Parameters
+        ----------
+        order_id : int
+        symbol : str
+        price : float or 'MKT'
+        side : str
+        quantity : int
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.closed:
+            raise Exception("engine is closed")
+        self.worker_of(symbol)["orders"].put((order_id, symbol, price, side, quantity))
+
+    def match(self, worker: dict):
+        """
+        Loop of a matching thread
+
+        Parameters
+        ----------
+        worker : dict
+
+        Returns
+        -------
+        None.
+
+        """
+        engine, orders = worker["engine"], worker["orders"]
+        while True:
+            item = orders.get()
+            try:
+                if item is None:
+                    return
+                row = pd.Series(
+                    item, index=["OrderID", "Symbol", "Price", "Side", "OrderQuantity"]
+                )
+                # duplicate check then recording of the id under order_ids_lock
+                engine.clean_and_ack(row)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                orders.task_done()
+
+    def sequence(self, seqs: dict, event):
+        """
+        Number an event in the sequence of its symbol and queue it for the publisher,
+        called by the thread owning the symbol
+
+        Parameters
+        ----------
+        seqs : dict
+            sequence numbers of the symbols of the thread.
+        event : AckEvent, RejectEvent, FillEvent or SweepEvent
+
+        Returns
+        -------
+        None.
+
+        """
+        seq = seqs.get(event.symbol, 0)
+        seqs[event.symbol] = seq + 1
+        self.events.put(SequencedEvent(event.symbol, seq, event))
+
+    def publish(self):
+        """
+        Loop of the publisher thread
+
+        Returns
+        -------
+        None.
+
+        """
+        while True:
+            sequenced = self.events.get()
+            try:
+                if sequenced is None:
+                    return
+                for callback in self.callbacks:
+                    callback(sequenced)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.events.task_done()
+
+    def flush(self):
+        """
+        Wait until every submitted order is matched and its events published
+
+        Returns
+        -------
+        None.
+
+        """
+        for worker in self.workers:
+            worker["orders"].join()
+        self.events.join()
+        if self.errors:
+            raise Exception("%d errors in the engine threads" % len(self.errors)) from (
+                self.errors[0]
+            )
+
+    def close(self):
+        """
+        Flush and stop the threads
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for worker in self.workers:
+            worker["orders"].put(None)
+        for worker in self.workers:
+            worker["thread"].join()
+        self.events.put(None)
+        self.publisher.join()
+        if self.errors:
+            raise Exception("%d errors in the engine threads" % len(self.errors)) from (
+                self.errors[0]
+            )
+
+    def books(self) -> dict:
+        """
+        Books of every thread, to be read once the engine is flushed
+
+        Returns
+        -------
+        dict
+            ticker -> FullBook.
+
+        """
+        books = {}
+        for worker in self.workers:
+            books.update(worker["engine"].books)
+        return books
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Differential testing of alternative book backends
+
+The same randomized order streams are replayed through the reference engine and
+a candidate engine (a MatchingEngine subclass, e.g. with another book_class).
+Acks, rejects, fills, level changes and the final content of the books (the
+snapshot method every book backend implements, see FullBook.snapshot) are
+compared event by event. The first divergence is reported with the smallest
+stream still reproducing it, and the time taken by both engines on each
+scenario gives the speedup of the candidate.
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from matching_engine import MatchingEngine
+
+COLUMNS = ["OrderID", "Symbol", "Price", "Side", "OrderQuantity"]
+
+# event index of the first difference and the two events, reproducer is the
+# smallest order stream found that still diverges
+Divergence = namedtuple(
+    "Divergence", "scenario seed index expected received reproducer"
+)
+# content of one side of a book at the end of a stream, levels from the lowest price
+BookState = namedtuple("BookState", "symbol side levels mkt_queue")
+
+
+def orders_frame(ids, symbols, prices, sides, quantities) -> pd.DataFrame:
+    """
+    DataFrame in the engine input format, prices are rounded to the tick and
+    NaN prices become market orders
+    """
+    prices = np.round(np.asarray(prices, dtype=float), 1)
+    return pd.DataFrame(
+        {
+            "OrderID": np.asarray(ids, dtype=np.int64),
+            "Symbol": symbols,
+            "Price": [("MKT" if np.isnan(p) else p) for p in prices],
+            "Side": np.where(np.asarray(sides), "Buy", "Sell"),
+            "OrderQuantity": np.asarray(quantities, dtype=np.int64),
+        },
+        columns=COLUMNS,
+    )
+
+
+def limit_scenario(rng, n: int) -> pd.DataFrame:
+    """Limit orders on both sides of a fixed mid, crossing only at the margin"""
+    buy = rng.random(n) < 0.5
+    prices = 100 + np.where(buy, -1, 1) * rng.integers(0, 20, n) * 0.1
+    return orders_frame(np.arange(n), "MSFT", prices, buy, rng.integers(1, 100, n))
+
+
+def crossing_scenario(rng, n: int) -> pd.DataFrame:
+    """Limit orders drawn around the mid, about half of them cross"""
+    prices = 100 + rng.normal(0, 1, n)
+    return orders_frame(
+        np.arange(n), "MSFT", prices, rng.random(n) < 0.5, rng.integers(1, 100, n)
+    )
+
+
+def mkt_scenario(rng, n: int) -> pd.DataFrame:
+    """A third of market orders queuing on both sides and crossed by the limits"""
+    prices = np.where(rng.random(n) < 0.33, np.nan, 100 + rng.normal(0, 1, n))
+    return orders_frame(
+        np.arange(n), "MSFT", prices, rng.random(n) < 0.5, rng.integers(1, 100, n)
+    )
+
+
+def deep_sweep_scenario(rng, n: int) -> pd.DataFrame:
+    """Deep books on many levels swept by rare large orders"""
+    buy = rng.random(n) < 0.5
+    prices = 100 + np.where(buy, -1, 1) * rng.integers(1, 200, n) * 0.1
+    quantities = rng.integers(1, 20, n)
+    sweeps = rng.random(n) < 0.02
+    prices[sweeps] = np.where(rng.random(sweeps.sum()) < 0.5, np.nan, 100.0)
+    prices[sweeps] += np.where(buy[sweeps], 30, -30)
+    quantities[sweeps] = rng.integers(200, 2000, sweeps.sum())
+    return orders_frame(np.arange(n), "MSFT", prices, buy, quantities)
+
+
+def out_of_order_scenario(rng, n: int) -> pd.DataFrame:
+    """Two symbols with OrderIDs shuffled within blocks of 8 orders"""
+    ids = np.arange(n)
+    for start in range(0, n, 8):
+        rng.shuffle(ids[start : start + 8])
+    prices = np.where(rng.random(n) < 0.1, np.nan, 100 + rng.integers(-5, 6, n) * 0.1)
+    return orders_frame(
+        ids,
+        rng.choice(["MSFT", "AAPL"], n),
+        prices,
+        rng.random(n) < 0.5,
+        rng.integers(1, 100, n),
+    )
+
+
+SCENARIOS = {
+    "limit": limit_scenario,
+    "crossing": crossing_scenario,
+    "mkt": mkt_scenario,
+    "deep_sweep": deep_sweep_scenario,
+    "out_of_order": out_of_order_scenario,
+}
+
+
+def book_states(engine) -> list:
+    """
+    Resting orders of every book from the snapshot method of the backend, see
+    FullBook.snapshot
+    """
+    states = []
+    for symbol in sorted(engine.books):
+        snapshot = engine.books[symbol].snapshot()
+        for side_name in ("Buy", "Sell"):
+            levels, mkt_queue = snapshot[side_name]
+            states.append(BookState(symbol, side_name, levels, mkt_queue))
+    return states
+
+
+def replay(engine_class, df: pd.DataFrame):
+    """
+    Run a stream through a fresh engine
+
+    Parameters
+    ----------
+    engine_class : callable
+        MatchingEngine or a subclass.
+    df : pd.DataFrame
+
+    Returns
+    -------
+    tuple
+        (events followed by the BookStates, seconds spent in load). An exception
+        raised by the engine, or by the snapshot of its books, ends the events.
+
+    """
+    engine = engine_class(text_logs=False)
+    events = []
+    for register in (
+        engine.on_ack,
+        engine.on_reject,
+        engine.on_fill,
+        engine.on_level_change,
+    ):
+        register(events.append)
+    start = time.perf_counter()
+    try:
+        engine.load(df=df.copy(), verbose=False)
+    except Exception as e:
+        events.append(("Exception", repr(e)))
+        return events, time.perf_counter() - start
+    seconds = time.perf_counter() - start
+    try:
+        events += book_states(engine)
+    except Exception as e:
+        events.append(("Exception", repr(e)))
+    return events, seconds
+
+
+def first_divergence(expected: list, received: list):
+    """
+    Index and events of the first difference, None if the streams match
+    """
+    for i, (a, b) in enumerate(zip(expected, received)):
+        if a != b:
+            return i, a, b
+    if len(expected) != len(received):
+        i = min(len(expected), len(received))
+        return (
+            i,
+            expected[i] if i < len(expected) else None,
+            received[i] if i < len(received) else None,
+        )
+    return None
+
+
+def diverges(candidate, df: pd.DataFrame, reference=MatchingEngine) -> bool:
+    """Whether the candidate and the reference disagree on a stream"""
+    expected, _ = replay(reference, df)
+    received, _ = replay(candidate, df)
+    return first_divergence(expected, received) is not None
+
+
+def minimize(candidate, df: pd.DataFrame, reference=MatchingEngine) -> pd.DataFrame:
+    """
+    Smallest stream found by removing chunks of orders, halving the chunk size
+    each time no chunk can be removed, that still makes the engines diverge
+
+    Parameters
+    ----------
+    candidate : callable
+    df : pd.DataFrame
+        stream on which the engines diverge.
+    reference : callable, optional
+        The default is MatchingEngine.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    rows = df.reset_index(drop=True)
+    chunk = max(len(rows) // 2, 1)
+    while True:
+        start, removed = 0, False
+        while start < len(rows):
+            trial = rows.drop(rows.index[start : start + chunk]).reset_index(drop=True)
+            if len(trial) and diverges(candidate, trial, reference):
+                rows, removed = trial, True
+            else:
+                start += chunk
+        if chunk == 1 and not removed:
+            return rows
+        if not removed:
+            chunk = max(chunk // 2, 1)
+
+
+def compare(
+    candidate,
+    reference=MatchingEngine,
+    scenarios: list = None,
+    orders: int = 2000,
+    seeds=(0, 1, 2),
+    reproduce: bool = True,
+    repeat: int = 3,
+):
+    """
+    Replay every scenario and seed through both engines
+
+    Parameters
+    ----------
+    candidate : callable
+        engine class under test, built with text_logs=False.
+    reference : callable, optional
+        The default is MatchingEngine.
+    scenarios : list, optional
+        names of SCENARIOS. The default is None, all of them.
+    orders : int, optional
+        orders per stream. The default is 2000.
+    seeds : iterable, optional
+        seeds of the streams. The default is (0, 1, 2).
+    reproduce : bool, optional
+        minimize the stream of each divergence. The default is True.
+    repeat : int, optional
+        runs of each engine on a stream, the fastest one is kept. The default is 3.
+
+    Returns
+    -------
+    tuple
+        (summary DataFrame with one row per scenario and seed: events, match,
+        first divergence index, reference and candidate seconds and speedup,
+        list of Divergence).
+
+    """
+    rows, divergences = [], []
+    for name in scenarios if scenarios is not None else list(SCENARIOS):
+        for seed in seeds:
+            df = SCENARIOS[name](np.random.default_rng(seed), orders)
+            expected, reference_seconds = replay(reference, df)
+            received, candidate_seconds = replay(candidate, df)
+            for _ in range(repeat - 1):
+                reference_seconds = min(reference_seconds, replay(reference, df)[1])
+                candidate_seconds = min(candidate_seconds, replay(candidate, df)[1])
+            divergence = first_divergence(expected, received)
+            if divergence is not None:
+                reproducer = minimize(candidate, df, reference) if reproduce else df
+                divergences.append(Divergence(name, seed, *divergence, reproducer))
+            rows.append(
+                {
+                    "scenario": name,
+                    "seed": seed,
+                    "events": len(expected),
+                    "match": divergence is None,
+                    "first_divergence": None if divergence is None else divergence[0],
+                    "reference_seconds": reference_seconds,
+                    "candidate_seconds": candidate_seconds,
+                    "speedup": reference_seconds / candidate_seconds,
+                }
+            )
+    return pd.DataFrame(rows), divergences
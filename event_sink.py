@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar binary sink for the engine events (Ack, Reject, Fill, SweepFill)
+
+Events are accumulated in typed column buffers and written at once as Arrow IPC or
+Parquet when pyarrow is installed, or as a packed binary file otherwise.
+read_events reads back any of those formats into a DataFrame.
+"""
+
+import struct
+from array import array
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from order_ids import INT64_MAX, INT64_MIN
+
+MAGIC = b"MEEVT001"
+ACK, REJECT, FILL, SWEEP = 0, 1, 2, 3
+ACTION_TYPES = ["Ack", "Reject", "Fill", "SweepFill"]
+
+# column name and array typecode, strings are stored as codes in a shared dictionary
+COLUMNS = [
+    ("kind", "B"),
+    ("order_id", "q"),
+    ("symbol", "i"),
+    ("price", "d"),
+    ("side", "i"),
+    ("quantity", "d"),
+    ("fill_price", "d"),
+    ("fill_quantity", "q"),
+    ("reason", "i"),
+]
+
+
+def _as_float(value) -> float:
+    """float value of a price or quantity, NaN for 'MKT' or anything non numeric"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _as_int(value) -> int:
+    """int value of an order id, -1 for anything non numeric or outside int64"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return -1
+    return value if INT64_MIN <= value <= INT64_MAX else -1
+
+
+class ColumnarEventSink:
+    """
+    Event sink accumulating the engine events in typed column buffers.
+    Pass it to MatchingEngine(sink=...) and call write once the orders are processed.
+    """
+
+    def __init__(self):
+        self.columns = {name: array(code) for name, code in COLUMNS}
+        self.strings = []  # shared dictionary for symbols, sides and reasons
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.columns["kind"])
+
+    def encode(self, value) -> int:
+        """
+        Code of a string in the shared dictionary, -1 for None
+
+        Parameters
+        ----------
+        value : str
+
+        Returns
+        -------
+        int
+
+        """
+        if value is None:
+            return -1
+        value = str(value)
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+    def append(
+        self,
+        kind: int,
+        order_id,
+        symbol,
+        price,
+        side,
+        quantity,
+        fill_price=None,
+        fill_quantity: int = 0,
+        reason: str = None,
+    ):
+        """
+        Append one event to the buffers
+
+        Returns
+        -------
+        None.
+
+        """
+        columns = self.columns
+        columns["kind"].append(kind)
+        columns["order_id"].append(_as_int(order_id))
+        columns["symbol"].append(self.encode(symbol))
+        columns["price"].append(_as_float(price))
+        columns["side"].append(self.encode(side))
+        columns["quantity"].append(_as_float(quantity))
+        columns["fill_price"].append(_as_float(fill_price))
+        columns["fill_quantity"].append(fill_quantity)
+        columns["reason"].append(self.encode(reason))
+
+    def ack(self, event):
+        """Buffer an AckEvent"""
+        self.append(
+            ACK, event.order_id, event.symbol, event.price, event.side, event.quantity
+        )
+
+    def reject(self, event):
+        """Buffer a RejectEvent"""
+        self.append(
+            REJECT,
+            event.order_id,
+            event.symbol,
+            event.price,
+            event.side,
+            event.quantity,
+            reason=event.reason,
+        )
+
+    def fill(self, event):
+        """Buffer a FillEvent"""
+        self.append(
+            FILL,
+            event.order_id,
+            event.symbol,
+            event.price,
+            event.side,
+            event.quantity,
+            event.fill_price,
+            event.fill_quantity,
+        )
+
+    def sweep(self, event):
+        """
+        Buffer a SweepEvent like the SweepFill rows of CsvLogger: filled at the
+        VWAP, the levels touched and the worst price going in the reason
+        """
+        self.append(
+            SWEEP,
+            event.order_id,
+            event.symbol,
+            event.price,
+            event.side,
+            event.quantity,
+            event.vwap,
+            event.filled_quantity,
+            "levels: %d, worst price: %s" % (event.levels, event.worst_price),
+        )
+
+    def to_arrays(self) -> dict:
+        """
+        Zero-copy numpy views over the column buffers
+
+        Returns
+        -------
+        dict
+            column name -> np.ndarray
+
+        """
+        return {
+            name: np.frombuffer(self.columns[name], dtype=code)
+            for name, code in COLUMNS
+        }
+
+    def write(self, file_path: str, fmt: str = None):
+        """
+        Write the events to disk
+
+        Parameters
+        ----------
+        file_path : str
+        fmt : str, optional
+            'parquet', 'arrow' or 'packed'. The default is parquet for a .parquet path
+            and arrow otherwise if pyarrow is installed, packed if it isn't.
+
+        Returns
+        -------
+        None.
+
+        """
+        if fmt is None:
+            if pa is None:
+                fmt = "packed"
+            elif file_path.endswith(".parquet"):
+                fmt = "parquet"
+            else:
+                fmt = "arrow"
+        if fmt == "packed":
+            self.write_packed(file_path)
+        elif fmt in ("arrow", "parquet"):
+            if pa is None:
+                raise Exception("pyarrow is needed to write " + fmt + " files")
+            table = self.to_table()
+            if fmt == "parquet":
+                pq.write_table(table, file_path)
+            else:
+                feather.write_feather(table, file_path, compression="uncompressed")
+        else:
+            raise Exception("fmt must be 'parquet', 'arrow' or 'packed'")
+
+    def to_table(self):
+        """
+        Arrow table of the events, strings are dictionary encoded
+
+        Returns
+        -------
+        pyarrow.Table
+
+        """
+        arrays = self.to_arrays()
+        dictionary = pa.array(self.strings, type=pa.string())
+        table = {}
+        for name, _ in COLUMNS:
+            if name in ("symbol", "side", "reason"):
+                codes = arrays[name]
+                table[name] = pa.DictionaryArray.from_arrays(
+                    pa.array(codes, mask=codes < 0), dictionary
+                )
+            else:
+                table[name] = pa.array(arrays[name])
+        return pa.table(table)
+
+    def write_packed(self, file_path: str):
+        """
+        Write the events as a packed binary file:
+        header (magic, number of events, number of strings), the string dictionary as
+        length-prefixed utf-8, padding to 8 bytes and the columns one after the other.
+
+        Parameters
+        ----------
+        file_path : str
+
+        Returns
+        -------
+        None.
+
+        """
+        with open(file_path, "wb") as f:
+            f.write(struct.pack("<8sQI", MAGIC, len(self), len(self.strings)))
+            for value in self.strings:
+                encoded = value.encode("utf-8")
+                f.write(struct.pack("<H", len(encoded)))
+                f.write(encoded)
+            f.write(b"\x00" * (-f.tell() % 8))
+            for name, _ in COLUMNS:
+                self.columns[name].tofile(f)
+
+
+def read_packed(file_path: str):
+    """
+    Read a packed event file
+
+    Parameters
+    ----------
+    file_path : str
+
+    Returns
+    -------
+    arrays : dict
+        column name -> np.ndarray, string columns hold codes.
+    strings : list of str
+        string dictionary.
+
+    """
+    with open(file_path, "rb") as f:
+        data = f.read()
+    magic, n_events, n_strings = struct.unpack_from("<8sQI", data)
+    if magic != MAGIC:
+        raise Exception(file_path + " is not a packed event file")
+    offset = struct.calcsize("<8sQI")
+    strings = []
+    for _ in range(n_strings):
+        (length,) = struct.unpack_from("<H", data, offset)
+        offset += 2
+        strings.append(data[offset : offset + length].decode("utf-8"))
+        offset += length
+    offset += -offset % 8
+    arrays = {}
+    for name, code in COLUMNS:
+        arrays[name] = np.frombuffer(data, dtype=code, count=n_events, offset=offset)
+        offset += arrays[name].nbytes
+    return arrays, strings
+
+
+def read_events(file_path: str) -> pd.DataFrame:
+    """
+    Read events written by ColumnarEventSink back into a DataFrame with the columns
+    of Matching_Logs.csv. Prices of market orders are NaN.
+
+    Parameters
+    ----------
+    file_path : str
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    with open(file_path, "rb") as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        arrays, strings = read_packed(file_path)
+        lookup = np.array(strings + [None], dtype=object)  # code -1 maps to None
+        for name in ("symbol", "side", "reason"):
+            arrays[name] = lookup[arrays[name]]
+    else:
+        if pa is None:
+            raise Exception("pyarrow is needed to read " + file_path)
+        if magic.startswith(b"PAR1"):
+            table = pq.read_table(file_path)
+        else:
+            table = feather.read_table(file_path)
+        arrays = {
+            name: table.column(name).to_numpy(zero_copy_only=False)
+            for name, _ in COLUMNS
+        }
+        for name in ("symbol", "side", "reason"):
+            arrays[name] = np.where(pd.isna(arrays[name]), None, arrays[name])
+
+    return pd.DataFrame(
+        {
+            "ActionType": np.array(ACTION_TYPES, dtype=object)[arrays["kind"]],
+            "OrderId": arrays["order_id"],
+            "Symbol": arrays["symbol"],
+            "Price": arrays["price"],
+            "Side": arrays["side"],
+            "OrderQuantity": arrays["quantity"],
+            "FillPrice": arrays["fill_price"],
+            "FillQuantity": arrays["fill_quantity"],
+            "Reason": arrays["reason"],
+        }
+    )
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio order-entry gateway of the matching engine
+
+Clients connect over TCP or a Unix socket and send one order per line, in the
+column order of the csv input:
+
+    OrderID;Symbol;Price;Side;OrderQuantity
+
+The orders received during one event loop iteration are loaded in the engine as
+one batch, with the checks of clean_and_ack. Each connection gets back the acks,
+rejects, fills and sweeps (engines with aggregate_sweeps) of its orders, one per
+line in the columns of Matching_Logs.csv separated by ';'.
+
+A connection stops being read while its outgoing queue is half full. Fills of
+resting orders keep coming from the other clients, so a client that still lets
+its queue reach max_queue lines is disconnected as a slow consumer: its queued
+lines are dropped and its resting orders stay in the book.
+"""
+
+import asyncio
+from collections import deque
+
+import pandas as pd
+
+from matching_engine import MatchingEngine
+
+COLUMNS = ["OrderID", "Symbol", "Price", "Side", "OrderQuantity"]
+MALFORMED = "Malformed order line, expected OrderID;Symbol;Price;Side;OrderQuantity"
+
+
+def format_event(event) -> str:
+    """
+    Line sent to the client for an event, in the columns of the csv logs
+
+    Parameters
+    ----------
+    event : AckEvent, RejectEvent, FillEvent or SweepEvent
+
+    Returns
+    -------
+    str
+
+    """
+    kind = type(event).__name__[: -len("Event")]
+    price = "MKT" if event.price is None else event.price
+    fields = [kind, event.order_id, event.symbol, price, event.side, event.quantity]
+    if kind == "Reject":
+        fields += ["", "", event.reason]
+    elif kind == "Fill":
+        fields += [event.fill_price, event.fill_quantity]
+    elif kind == "Sweep":
+        # SweepFill row of CsvLogger
+        fields[0] = "SweepFill"
+        fields += [
+            event.vwap,
+            event.filled_quantity,
+            "levels: %d, worst price: %s" % (event.levels, event.worst_price),
+        ]
+    return ";".join(str(field) for field in fields)
+
+
+class Connection:
+    """
+    One client, its outgoing lines are buffered and written by a writer task
+    """
+
+    def __init__(self, reader, writer, max_queue: int):
+        self.reader = reader
+        self.writer = writer
+        self.max_queue = max_queue
+        self.out = deque()
+        self.pause_at = max(max_queue // 2, 1)
+        self.ready = asyncio.Event()  # lines waiting to be written
+        self.room = asyncio.Event()  # outgoing queue below pause_at
+        self.room.set()
+        self.closed = False
+        self.slow = False  # disconnected for reaching max_queue
+
+    def send(self, line: str):
+        """
+        Queue a line for the client, it is dropped once the client is gone.
+        The client is disconnected when its queue reaches max_queue.
+
+        Parameters
+        ----------
+        line : str
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.closed:
+            return
+        if len(self.out) >= self.max_queue:
+            self.slow = True
+            self.disconnect()
+            return
+        self.out.append(line)
+        self.ready.set()
+        if len(self.out) >= self.pause_at:
+            self.room.clear()
+
+    def disconnect(self):
+        """
+        Drop the queued lines and abort the connection, the reader gets EOF
+
+        Returns
+        -------
+        None.
+
+        """
+        self.closed = True
+        self.out.clear()
+        self.ready.set()
+        self.room.set()
+        self.writer.transport.abort()
+
+    async def write_loop(self):
+        """
+        Write the queued lines until the connection is closed and drained
+
+        Returns
+        -------
+        None.
+
+        """
+        try:
+            while True:
+                await self.ready.wait()
+                while self.out:
+                    self.writer.write((self.out.popleft() + "\n").encode())
+                self.ready.clear()
+                self.room.set()
+                if self.closed:
+                    break
+                await self.writer.drain()  # waits while the socket buffer is full
+        except ConnectionError:
+            # the client is gone, the lines still to come are dropped
+            self.closed = True
+            self.out.clear()
+            self.room.set()
+
+
+class OrderGateway:
+    """
+    Gateway running one MatchingEngine for many clients on one event loop
+    """
+
+    def __init__(self, engine: MatchingEngine = None, max_queue: int = 1024):
+        """
+
+        Parameters
+        ----------
+        engine : MatchingEngine, optional
+            The default is None, an engine without text logs.
+        max_queue : int, optional
+            outgoing lines a connection may hold, it stops being read at half
+            of it and is disconnected when it is reached. The default is 1024.
+
+        Returns
+        -------
+        None.
+
+        """
+        if max_queue <= 0:
+            raise Exception("max_queue must be strictly positive")
+        self.engine = MatchingEngine(text_logs=False) if engine is None else engine
+        self.max_queue = max_queue
+        # (connection, fields) of the next batch, fields is None for a malformed line
+        self.pending = []
+        self.scheduled = False
+        # connection of each row of the batch, acks and rejects come one per row
+        self.batch_connections = deque()
+        # order id -> [connection, remaining quantity] of the accepted orders
+        self.owners = {}
+        self.handlers = set()  # tasks of the connected clients
+        self.engine.on_ack(self.ack)
+        self.engine.on_reject(self.reject)
+        self.engine.on_fill(self.fill)
+        self.engine.on_sweep(self.sweep)
+
+    async def start_tcp(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        Listen on a TCP socket
+
+        Returns
+        -------
+        asyncio.Server
+            port 0 picks a free port, see server.sockets[0].getsockname().
+
+        """
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def start_unix(self, path: str):
+        """
+        Listen on a Unix socket
+
+        Returns
+        -------
+        asyncio.Server
+
+        """
+        return await asyncio.start_unix_server(self.handle, path)
+
+    async def handle(self, reader, writer):
+        """
+        Read the orders of one client until it disconnects
+
+        Returns
+        -------
+        None.
+
+        """
+        self.handlers.add(asyncio.current_task())
+        connection = Connection(reader, writer, self.max_queue)
+        write_task = asyncio.ensure_future(connection.write_loop())
+        try:
+            while not connection.closed:
+                await connection.room.wait()  # backpressure
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().strip()
+                if line:
+                    self.submit(connection, line)
+        except ConnectionError:
+            pass  # reset by the client, same as a disconnection
+        finally:
+            # the last batch of the client is still answered
+            while self.scheduled or self.pending:
+                await asyncio.sleep(0)
+            connection.closed = True
+            connection.ready.set()
+            try:
+                await write_task
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+                self.handlers.discard(asyncio.current_task())
+
+    async def wait_clients(self):
+        """
+        Wait until the connected clients are gone and got all their answers
+
+        Returns
+        -------
+        None.
+
+        """
+        while self.handlers:
+            await asyncio.gather(*self.handlers)
+
+    def submit(self, connection: Connection, line: str):
+        """
+        Add an order line to the batch of the current loop iteration
+
+        Parameters
+        ----------
+        connection : Connection
+        line : str
+
+        Returns
+        -------
+        None.
+
+        """
+        fields = line.split(";")
+        if len(fields) != len(COLUMNS):
+            fields = None  # rejected in its place in the batch
+        self.pending.append((connection, fields))
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.run_batch)
+
+    def run_batch(self):
+        """
+        Load the orders received since the last batch in the engine, the
+        malformed lines are rejected between the orders around them so every
+        client gets its answers in the order of its lines
+
+        Returns
+        -------
+        None.
+
+        """
+        batch, self.pending = self.pending, []
+        self.scheduled = False
+        rows = []
+        for connection, fields in batch:
+            if fields is not None:
+                rows.append((connection, fields))
+                continue
+            if rows:
+                self.load_rows(rows)
+                rows = []
+            connection.send("Reject;;;;;;;;" + MALFORMED)
+        if rows:
+            self.load_rows(rows)
+
+    def load_rows(self, rows: list):
+        """
+        Load well formed order lines in the engine as one batch
+
+        Parameters
+        ----------
+        rows : list
+            (connection, fields) of the orders.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.batch_connections.extend(connection for connection, _ in rows)
+        df = pd.DataFrame([fields for _, fields in rows], columns=COLUMNS)
+        try:
+            self.engine.load(df=df, verbose=False)
+        finally:
+            self.batch_connections.clear()
+
+    def ack(self, event):
+        connection = self.batch_connections.popleft()
+        self.owners[event.order_id] = [connection, event.quantity]
+        connection.send(format_event(event))
+
+    def reject(self, event):
+        self.batch_connections.popleft().send(format_event(event))
+
+    def fill(self, event):
+        self.send_to_owner(event, event.fill_quantity)
+
+    def sweep(self, event):
+        self.send_to_owner(event, event.filled_quantity)
+
+    def send_to_owner(self, event, quantity: int):
+        """
+        Send a fill or sweep to the connection of the order, forgetting the order
+        once it is fully filled
+
+        Parameters
+        ----------
+        event : FillEvent or SweepEvent
+        quantity : int
+            quantity filled by the event.
+
+        Returns
+        -------
+        None.
+
+        """
+        owner = self.owners.get(event.order_id)
+        if owner is None:
+            return
+        owner[1] -= quantity
+        if owner[1] <= 0:
+            del self.owners[event.order_id]
+        owner[0].send(format_event(event))
@@ -6,7 +6,36 @@ Created on Sun Jun 19 23:29:13 2022
 """
 
 import pandas as pd
+import numpy as np
 import csv
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from contextlib import nullcontext
+from urllib.parse import quote
+
+from binary_orders import BUY, MARKET, TICK, read_orders
+from order_ids import INT64_MAX, INT64_MIN, OrderIdIndex
+from top_of_book import TopOfBookRecorder
+
+DUPLICATE_ID = "Duplicate OrderID, already used by an accepted order"
+
+# typed events handed to the subscribers, price is None for market orders
+# (rejects keep the price as received), resting is True for the book side of a fill
+AckEvent = namedtuple("AckEvent", "order_id symbol price side quantity")
+RejectEvent = namedtuple("RejectEvent", "order_id symbol price side quantity reason")
+FillEvent = namedtuple(
+    "FillEvent",
+    "order_id symbol price side quantity fill_price fill_quantity resting",
+)
+LevelChangeEvent = namedtuple("LevelChangeEvent", "symbol side price quantity")
+# summary of the fills of an incoming order in aggregated sweep reporting
+SweepEvent = namedtuple(
+    "SweepEvent",
+    "order_id symbol price side quantity filled_quantity vwap levels worst_price",
+)
 
 
 class Order:
@@ -72,6 +101,8 @@ class Level:
             self.price = order.price
         self.side = order.side
         self.total_quantity = order.remaining
+        self.orders = 1  # number of orders in the queue
+        self.direction: Direction = None  # set for the limit levels of the tree
         # queue reference
         self.top: Order = order
         self.bottom: Order = order
@@ -98,12 +129,115 @@ class Level:
         # updating queue
         if self.top is None:
             self.top = new_order
+            if self.direction is not None:
+                self.direction.level_filled(self)
         else:
             self.bottom.next = new_order  # updating the position of previous bottom and new with respect to each others
         new_order.previous = self.bottom
         self.bottom = new_order  # adding at bottom of queue
         # updating global quantity
         self.total_quantity += new_order.remaining
+        self.count_order(new_order)
+
+    def count_order(self, new_order: Order):
+        """
+        Account for an order entering the queue in the counters of the level
+        and of its direction
+
+        Parameters
+        ----------
+        new_order : Order
+
+        Returns
+        -------
+        None.
+
+        """
+        self.orders += 1
+        if self.direction is not None:
+            self.direction.resting_orders += 1
+            self.direction.global_quantity += new_order.remaining
+
+    def reduce(self, qty: int):
+        """
+        Take traded quantity out of the level
+
+        Parameters
+        ----------
+        qty : int
+
+        Returns
+        -------
+        None.
+
+        """
+        self.total_quantity -= qty
+        if self.direction is not None:
+            self.direction.global_quantity -= qty
+
+    def consume(self, qty: int) -> list:
+        """
+        Take qty off the front of the queue in FIFO order, the filled orders are
+        unlinked at once and the counters updated once
+
+        Parameters
+        ----------
+        qty : int
+            at most total_quantity.
+
+        Returns
+        -------
+        list
+            (order, traded quantity) of the orders hit, in queue order.
+
+        """
+        if qty > self.total_quantity:
+            raise Exception("can't consume more than the level quantity")
+        if qty <= 0:
+            return []
+        slices = []
+        filled = 0
+        order = self.top
+        left = qty
+        # walking down the queue until the cumulated quantity reaches qty
+        while left > 0:
+            traded = order.remaining if order.remaining < left else left
+            slices.append((order, traded))
+            order.remaining -= traded
+            left -= traded
+            if order.remaining == 0:
+                filled += 1
+                order = order.next
+        # the orders before `order` are filled, it becomes the new top
+        self.top = order
+        if order is None:
+            self.bottom = None
+        else:
+            order.previous = None
+        self.orders -= filled
+        self.reduce(qty)
+        if self.direction is not None:
+            self.direction.resting_orders -= filled
+            if order is None:
+                self.direction.level_emptied(self)
+        return slices
+
+    def snapshot(self) -> tuple:
+        """
+        Orders of the queue in time priority
+
+        Returns
+        -------
+        tuple
+            ((id, remaining), ...).
+
+        """
+        content = []
+        order = self.top
+        while order is not None:
+            content.append((order.id, order.remaining))
+            order = order.next
+        return tuple(content)
 
     def scalp_from_queue(self):
         """
@@ -122,6 +256,11 @@ class Level:
                 self.top.previous = (
                     None  # updating the position of the new top of queue
                 )
+            self.orders -= 1
+            if self.direction is not None:
+                self.direction.resting_orders -= 1
+                if self.top is None:
+                    self.direction.level_emptied(self)
         if taken_order == self.bottom:
             self.bottom = None  # if the queue is finished
 
@@ -143,20 +282,40 @@ class Level:
         if not isinstance(inserted_order, Order):
             raise Exception("inserted_order is not an Order object")
 
-        if inserted_order.id >= self.bottom.id:
-            self.add_to_queue(inserted_order)
+        if (self.bottom is None) or (inserted_order.id >= self.bottom.id):
+            self.add_to_queue(inserted_order)  # also updates the size of level
+            return
+        # walking up from the bottom to the first order with a higher id
+        order_after = self.bottom
+        while (order_after.previous is not None) and (
+            order_after.previous.id > inserted_order.id
+        ):
+            order_after = order_after.previous
+        # inserting in the queue
+        order_before = order_after.previous
+        order_after.previous = inserted_order
+        inserted_order.next = order_after
+        inserted_order.previous = order_before
+        if order_before is None:
+            self.top = inserted_order
         else:
-            order_after = self.bottom.previous
-            while (order_after is not None) & (order_after.id > inserted_order.id):
-                order_after = order_after.previous
-            # inserting in the queue
-            order_before = order_after.previous
-            order_after.previous = inserted_order
-            inserted_order.next = order_after
-            inserted_order.previous = order_before
             order_before.next = inserted_order
         # updating the size of level
         self.total_quantity += inserted_order.remaining
+        self.count_order(inserted_order)
+
+
+def object_bytes(obj) -> int:
+    """
+    Size of an object and of its attribute dictionary, the attributes themselves
+    are not followed
+    """
+    return sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+
+
+# approximate footprint of the book objects, used by the stats
+ORDER_BYTES = object_bytes(Order(0, "", 1, "Buy", "LIMIT", 1.0))
+LEVEL_BYTES = object_bytes(Level(Order(0, "", 1, "Buy", "LIMIT", 1.0)))
 
 
 class Direction:
@@ -165,8 +324,16 @@ class Direction:
     def __init__(self, side: int):
         self.root = None  # initial price level
         self.side = side
-        self.global_quantity = 0  # total quantity on that side
+        self.global_quantity = 0  # total quantity resting in the levels of that side
         self.mkt_available: Level = None
+        # counters maintained on every change of the levels, see stats
+        self.levels = 0  # levels in the tree, emptied ones included
+        self.live_levels = 0  # levels holding orders
+        self.resting_orders = 0
+        self.height = 0  # depth of the deepest level, the root being at depth 1
+        # best level holding orders, emptied levels stay in the tree so it is
+        # kept up to date as levels empty and fill rather than searched
+        self.best: Level = None
 
     def log_order(self, logged_order: Order):
         """
@@ -178,42 +345,97 @@ class Direction:
 
         Returns
         -------
-        None.
+        Level
+            level the order was logged in.
 
         """
         if not isinstance(logged_order, Order):
             raise Exception("logged_order is not an Order object")
 
+        depth = 1
         if self.root is not None:
-            # searching the levels in a binary search fashion
+            # searching the levels in a binary search fashion, higher prices on the right
             exploring = self.root
             while exploring is not None:
                 if exploring.price < logged_order.price:
-                    if exploring.left is not None:
-                        exploring = exploring.left
+                    if exploring.right is not None:
+                        exploring = exploring.right
+                        depth += 1
                     else:
                         break
                 elif exploring.price > logged_order.price:
-                    if exploring.right is not None:
-                        exploring = exploring.right
+                    if exploring.left is not None:
+                        exploring = exploring.left
+                        depth += 1
                     else:
                         break
                 else:
                     exploring.insert_in_queue(
                         logged_order
                     )  # we found the level so we just add the order to it
-                    return
+                    return exploring
             # there was no corresponding level so we create one and link it to the tree
+            level = Level(logged_order)
             if logged_order.price > exploring.price:
-                exploring.right = Level(logged_order)
-                exploring.right.parent = exploring
+                exploring.right = level
             else:
-                exploring.left = Level(logged_order)
-                exploring.left.parent = exploring
+                exploring.left = level
+            level.parent = exploring
+            depth += 1
         else:
-            self.root = Level(logged_order)
+            level = self.root = Level(logged_order)
+
+        level.direction = self
+        self.levels += 1
+        self.level_filled(level)
+        self.resting_orders += 1
+        self.global_quantity += logged_order.remaining  # adding quantity
+        self.height = max(self.height, depth)
+        return level
+
+    def level_filled(self, level: Level):
+        """
+        Account for a level of the tree starting to hold orders
+
+        Parameters
+        ----------
+        level : Level
+
+        Returns
+        -------
+        None.
+
+        """
+        self.live_levels += 1
+        best = self.best
+        if (
+            (best is None)
+            or (self.side and (level.price > best.price))
+            or ((not self.side) and (level.price < best.price))
+        ):
+            self.best = level
+
+    def level_emptied(self, level: Level):
+        """
+        Account for a level of the tree left without orders, the best level then
+        moves to the next level holding orders away from the best price
+
+        Parameters
+        ----------
+        level : Level
+
+        Returns
+        -------
+        None.
 
-        self.global_quantity += logged_order.size  # adding quantity
+        """
+        self.live_levels -= 1
+        if level is self.best:
+            order_type = "Sell" if self.side else "Buy"
+            level = self.next_price(level, order_type)
+            while (level is not None) and (level.top is None):
+                level = self.next_price(level, order_type)
+            self.best = level
 
     def extreme_finder(
         self, minmax: bool = True, starting_point: Level = None
@@ -306,7 +528,7 @@ class Direction:
                     potential_target = level.parent
                     cur = level
                     if potential_target is not None:
-                        while (potential_target is not None) & (
+                        while (potential_target is not None) and (
                             cur == potential_target.left
                         ):
                             potential_target = potential_target.parent
@@ -315,6 +537,18 @@ class Direction:
                     else:
                         return None
 
+    def best_level(self) -> Level:
+        """
+        Best price level still holding orders (highest bid or lowest ask), O(1)
+
+        Returns
+        -------
+        Level
+            None if the side is empty.
+
+        """
+        return self.best
+
     def load_Mkt(self, order: Order):
         """
         Add mkt order to market queue if existing, creates it otherwise
@@ -325,7 +559,8 @@ class Direction:
 
         Returns
         -------
-        None.
+        Level
+            the market order level.
 
         """
         if not isinstance(order, Order):
@@ -334,194 +569,725 @@ class Direction:
             self.mkt_available.insert_in_queue(order)
         else:
             self.mkt_available = Level(order)
+        return self.mkt_available
 
+    def stats(self, verify: bool = False) -> dict:
+        """
+        Counters of the side, maintained on every change so the call is O(1)
 
-class FullBook:
+        Parameters
+        ----------
+        verify : bool, optional
+            walk the whole tree and the queues to check the counters, O(n).
+            The default is False.
+
+        Returns
+        -------
+        dict
+            resting_orders, levels, live_levels, empty_levels, height,
+            global_quantity, mkt_orders, mkt_quantity and approximate bytes,
+            plus mismatches (names of the wrong counters) when verify is set.
+
+        """
+        mkt = self.mkt_available
+        mkt_orders = 0 if mkt is None else mkt.orders
+        stats = {
+            "resting_orders": self.resting_orders,
+            "levels": self.levels,
+            "live_levels": self.live_levels,
+            "empty_levels": self.levels - self.live_levels,
+            "height": self.height,
+            "global_quantity": self.global_quantity,
+            "mkt_orders": mkt_orders,
+            "mkt_quantity": 0 if mkt is None else mkt.total_quantity,
+            "bytes": (self.levels + (mkt is not None)) * LEVEL_BYTES
+            + (self.resting_orders + mkt_orders) * ORDER_BYTES,
+        }
+        if verify:
+            stats["mismatches"] = self.verify(stats)
+        return stats
+
+    def verify(self, stats: dict) -> list:
+        """
+        Recount the side by walking the tree and the queues
+
+        Parameters
+        ----------
+        stats : dict
+            counters returned by stats.
+
+        Returns
+        -------
+        list
+            names of the counters that don't match, "level_queues" if the size of
+            a level doesn't match its queue, "tree_order" if the levels are not
+            sorted and "best_level" if best is not the best level holding orders.
+
+        """
+        counted = {
+            "resting_orders": 0,
+            "levels": 0,
+            "live_levels": 0,
+            "height": 0,
+            "global_quantity": 0,
+            "mkt_orders": 0,
+            "mkt_quantity": 0,
+        }
+        mismatches = []
+        best = None
+        # levels with their depth and the price bounds set by their ancestors
+        stack = [] if self.root is None else [(self.root, 1, None, None)]
+        while stack:
+            level, depth, low, high = stack.pop()
+            orders, quantity = self.count_queue(level)
+            counted["levels"] += 1
+            counted["live_levels"] += orders > 0
+            counted["resting_orders"] += orders
+            counted["global_quantity"] += quantity
+            counted["height"] = max(counted["height"], depth)
+            if (orders > 0) and (
+                (best is None)
+                or (self.side and (level.price > best.price))
+                or ((not self.side) and (level.price < best.price))
+            ):
+                best = level
+            if (orders != level.orders) or (quantity != level.total_quantity):
+                mismatches.append("level_queues")
+            if ((low is not None) and (level.price <= low)) or (
+                (high is not None) and (level.price >= high)
+            ):
+                mismatches.append("tree_order")
+            if level.left is not None:
+                stack.append((level.left, depth + 1, low, level.price))
+            if level.right is not None:
+                stack.append((level.right, depth + 1, level.price, high))
+        if self.mkt_available is not None:
+            orders, quantity = self.count_queue(self.mkt_available)
+            counted["mkt_orders"] = orders
+            counted["mkt_quantity"] = quantity
+        for name, value in counted.items():
+            if stats[name] != value:
+                mismatches.append(name)
+        if best is not self.best:
+            mismatches.append("best_level")
+        return sorted(set(mismatches))
+
+    @staticmethod
+    def count_queue(level: Level):
+        """
+        Number of orders and remaining quantity in the queue of a level
+
+        Parameters
+        ----------
+        level : Level
+
+        Returns
+        -------
+        tuple
+            (orders, quantity).
+
+        """
+        orders, quantity = 0, 0
+        order = level.top
+        while order is not None:
+            orders += 1
+            quantity += order.remaining
+            order = order.next
+        return orders, quantity
+
+
+class TradeStats:
     """
-    Full book for a ticker with both directions (bid and ask)
-    This is the level where match are made
+    Trade statistics of one book updated in O(1) on every fill:
+    last price, session VWAP, cumulative volume and OHLCV bars
     """
 
-    def __init__(self, ticker):
-        self.ticker = ticker
-        self.bid = Direction(1)
-        self.ask = Direction(0)
+    bar_fields = ["start", "open", "high", "low", "close", "volume"]
+    bar_dtype = np.dtype(
+        [
+            ("start", "f8"),
+            ("open", "f8"),
+            ("high", "f8"),
+            ("low", "f8"),
+            ("close", "f8"),
+            ("volume", "i8"),
+        ]
+    )
 
-    def add_order_to_book(self, order_to_add: Order):
+    def __init__(self, bar_interval: float = 60.0, clock=time.time):
         """
-        Head function to add order to book
 
         Parameters
         ----------
-        order_to_add : order
+        bar_interval : float, optional
+            length of the bars in seconds. The default is 60.
+        clock : callable, optional
+            returns the current time in seconds. The default is time.time.
 
         Returns
         -------
         None.
 
         """
-        # check if the order is limit as all mkt orders are priced None
-        if not isinstance(order_to_add, Order):
-            raise Exception("order input is not an Order instance")
-        if order_to_add.price:
-            self.run_limit_order(order_to_add)
-        else:
-            self.run_mkt_order(order_to_add)
-
-    def run_limit_order(self, limit_order: Order):
+        if bar_interval <= 0:
+            raise Exception("bar_interval must be strictly positive")
+        self.bar_interval = bar_interval
+        self.clock = clock
+        self.last_price = None
+        self.volume = 0
+        self.notional = 0.0
+        self.trades = 0
+        # current bar, the finished ones are appended to typed columns
+        self.bar = None
+        self.bars = {
+            name: array("q" if name == "volume" else "d") for name in self.bar_fields
+        }
+
+    def update(self, price: float, qty: int, trades: int = 1):
         """
-        Will run the trade if liquidity is found (ask higher than order price or bid lower than order price)
-        We will maintain the price priority when buy orders for example are posted higher than 2 current limit
+        Account for one trade, or several trades at the same price
+
         Parameters
         ----------
-        limit_order : limit Order
+        price : float
+        qty : int
+            total quantity of the trades.
+        trades : int, optional
+            number of trades. The default is 1.
 
         Returns
         -------
         None.
 
         """
-        if not isinstance(limit_order, Order):
-            raise Exception("limit_order input not an Order instance")
-        if limit_order.side == "Buy":
-            best_level = self.ask.extreme_finder(
-                False
-            )  # finding the minimum price on the ask side
-            mkt_orders = (
-                self.ask.mkt_available
-            )  # checking that there is no mkt orders with high time priority (eventhough there shouldn't be)
-            mkt_queue = (
-                self.bid.mkt_available
-            )  # market order sitting there because no price
-            # as the limit order would be filled on the spot if a mkt is standing
-            direction = self.bid
+        now = self.clock()
+        start = now - now % self.bar_interval
+        bar = self.bar
+        if (bar is None) or (bar[0] != start):
+            if bar is not None:
+                for column, value in zip(self.bars.values(), bar):
+                    column.append(value)
+            self.bar = [start, price, price, price, price, qty]
         else:
-            best_level = self.bid.extreme_finder(True)  # max price on bid side
-            mkt_orders = self.bid.mkt_available
-            mkt_queue = self.ask.mkt_available
-            direction = self.ask
-        if mkt_orders is not None:
-            if mkt_queue is not None:
-                self.spend_liquidity(mkt_orders, mkt_queue, limit_order.price)
-            # trading market liquidity first
+            if price > bar[2]:
+                bar[2] = price
+            elif price < bar[3]:
+                bar[3] = price
+            bar[4] = price
+            bar[5] += qty
+        self.last_price = price
+        self.volume += qty
+        self.notional += price * qty
+        self.trades += trades
+
+    @property
+    def vwap(self) -> float:
+        """session VWAP, None before the first trade"""
+        if self.volume == 0:
+            return None
+        return self.notional / self.volume
 
-            while (limit_order.remaining > 0) & (mkt_orders.top is not None):
-                self.trade(limit_order, mkt_orders)
+    def to_bars(self) -> np.ndarray:
+        """
+        OHLCV bars including the current one
 
-        if best_level is not None:
-            if limit_order.side == "Buy":
-                while (limit_order.remaining > 0) & (
-                    best_level.price <= limit_order.price
-                ):
-                    self.trade(limit_order, best_level)
-                    if (best_level.top is None) & (
-                        direction.next_price(best_level, limit_order.side) is not None
-                    ):
-                        # switching level
-                        best_level = direction.next_price(best_level, limit_order.side)
-            else:
-                while (limit_order.remaining > 0) & (
-                    best_level.price >= limit_order.price
-                ):
-                    self.trade(limit_order, best_level)
-                    if (best_level.top is None) & (
-                        direction.next_price(best_level, limit_order.side) is not None
-                    ):
-                        # switching level
-                        best_level = direction.next_price(best_level, limit_order.side)
-            if limit_order.remaining > 0:
-                #
-                self.log_limit_order(limit_order)
-        else:
-            self.log_limit_order(limit_order)
-            # trade level and go up levels
+        Returns
+        -------
+        np.ndarray
+            structured array with bar_dtype, start is the bar opening time.
 
-    def spend_liquidity(self, mkt_orders: Level, mkt_queue: Level, price: float):
         """
-        Consume the mkt books once a price as come in
+        n = len(self.bars["start"])
+        bars = np.empty(n + (self.bar is not None), dtype=self.bar_dtype)
+        for name in self.bar_fields:
+            bars[name][:n] = np.frombuffer(self.bars[name], dtype=bars[name].dtype)
+        if self.bar is not None:
+            bars[n] = tuple(self.bar)
+        return bars
+
+    def rolling_volume(self, window: float) -> int:
+        """
+        Volume traded in the bars opened during the last window seconds
 
         Parameters
         ----------
-        mkt_order : Mkt order Level
+        window : float
+            in seconds.
 
-        mkt_queue : Mkt order Level (other side of the book)
+        Returns
+        -------
+        int
 
-        price : price discovered by the arrived limit price
+        """
+        since = self.clock() - window
+        volume = 0
+        if (self.bar is not None) and (self.bar[0] >= since):
+            volume += self.bar[5]
+        starts, volumes = self.bars["start"], self.bars["volume"]
+        i = len(starts) - 1
+        while (i >= 0) and (starts[i] >= since):
+            volume += volumes[i]
+            i -= 1
+        return volume
+
+
+class FullBook:
+    """
+    Full book for a ticker with both directions (bid and ask)
+    This is the level where match are made
+    """
+
+    def __init__(
+        self, ticker, aggregate_sweeps: bool = False, bar_interval: float = 60.0
+    ):
+        """
 
+        Parameters
+        ----------
+        ticker : instrument ticker
+        aggregate_sweeps : bool, optional
+            report the fills of an incoming order as one SweepEvent instead of one
+            FillEvent per resting order it hits, the resting orders still get their
+            FillEvent. The default is False.
+        bar_interval : float, optional
+            length in seconds of the OHLCV bars of trade_stats. The default is 60.
 
         Returns
         -------
         None.
 
         """
-        if mkt_queue is not None:
-            if not isinstance(mkt_queue, Level):
-                raise Exception("mkt_queue is not Level instance")
-        if mkt_orders is not None:
-            if not isinstance(mkt_orders, Level):
-                raise Exception("mkt_orders is not Level instance")
-        while (mkt_queue.top is not None) & (mkt_orders.top is not None):
-            if mkt_orders.top.remaining >= mkt_queue.top.remaining:
-                mkt_orders.top.remaining -= mkt_queue.top.remaining
-                mkt_orders.total_quantity -= mkt_queue.top.remaining
-                mkt_queue.total_quantity -= mkt_queue.top.remaining
-                # respecting time priority in display
-                if mkt_orders.top.id > mkt_queue.top.id:
-                    self.output(
-                        mkt_orders.top, mkt_queue.top, price, mkt_queue.top.remaining
-                    )
-                else:
-                    self.output(
-                        mkt_queue.top, mkt_orders.top, price, mkt_queue.top.remaining
-                    )
-                mkt_queue.top.remaining = 0
+        self.ticker = ticker
+        self.bid = Direction(1)
+        self.ask = Direction(0)
+        # subscribers, events are only built when the lists are not empty
+        self.fill_callbacks = []
+        self.level_callbacks = []
+        self.sweep_callbacks = []
+        self.aggregate_sweeps = aggregate_sweeps
+        self.sweep = None  # (resting order, price, qty) of the incoming order fills
+        self.sweep_order = None
+        self.trade_stats = TradeStats(bar_interval)
+        self.recorder: TopOfBookRecorder = None  # top of book after every order
+        self.risk_state = None  # risk.SymbolRisk updated on each fill
+
+    def on_fill(self, callback):
+        """
+        Register a callback receiving a FillEvent for each side of every fill
 
-            else:
-                mkt_queue.top.remaining -= mkt_orders.top.remaining
-                mkt_queue.total_quantity -= mkt_orders.top.remaining
-                mkt_orders.total_quantity -= mkt_orders.top.remaining
-                if mkt_orders.top.id > mkt_queue.top.id:
-                    self.output(
-                        mkt_orders.top, mkt_queue.top, price, mkt_orders.top.remaining
-                    )
-                else:
-                    self.output(
-                        mkt_queue.top, mkt_orders.top, price, mkt_orders.top.remaining
-                    )
-                mkt_orders.top.remaining = 0
+        Parameters
+        ----------
+        callback : callable
 
-            if mkt_orders.top.remaining == 0:
-                mkt_orders.scalp_from_queue()
-            if mkt_queue.top.remaining == 0:
-                mkt_queue.scalp_from_queue()
+        Returns
+        -------
+        None.
 
-    def trade(self, client_order: Order, level_order: Level):
         """
-        Matching orders
+        self.fill_callbacks.append(callback)
+
+    def on_level_change(self, callback):
+        """
+        Register a callback receiving a LevelChangeEvent each time the quantity
+        of a price level (or of a market order level) changes
 
         Parameters
         ----------
-        client_order : Order
-            DESCRIPTION.
-        level_order : Level
-            DESCRIPTION.
+        callback : callable
 
         Returns
         -------
-        level_order : TYPE
-            DESCRIPTION.
+        None.
 
         """
-        if not isinstance(client_order, Order):
-            raise Exception("client_order is not Order instance")
-        if not isinstance(level_order, Level):
-            raise Exception("level_order is not Level instance")
+        self.level_callbacks.append(callback)
 
-        if client_order.remaining <= level_order.top.remaining:
-            level_order.top.remaining -= client_order.remaining
-            level_order.total_quantity -= client_order.remaining
+    def on_sweep(self, callback):
+        """
+        Register a callback receiving a SweepEvent for every incoming order that
+        traded, when aggregate_sweeps is set
 
-            if client_order.order_type == "MKT":
+        Parameters
+        ----------
+        callback : callable
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sweep_callbacks.append(callback)
+
+    def level_change(self, level: Level):
+        """
+        Send the new quantity of a level to the level subscribers
+
+        Parameters
+        ----------
+        level : Level
+
+        Returns
+        -------
+        None.
+
+        """
+        event = LevelChangeEvent(
+            self.ticker,
+            level.side,
+            level.price if level.type == "limit" else None,
+            level.total_quantity,
+        )
+        for callback in self.level_callbacks:
+            callback(event)
+
+    def is_empty(self) -> bool:
+        """
+        Whether the book has no resting orders and no market orders waiting
+
+        Returns
+        -------
+        bool
+
+        """
+        for side in (self.bid, self.ask):
+            if side.resting_orders > 0:
+                return False
+            if (side.mkt_available is not None) and (side.mkt_available.orders > 0):
+                return False
+        return True
+
+    def snapshot(self) -> dict:
+        """
+        Resting orders of the book, the state alternative book backends are
+        compared on (see differential.py)
+
+        Returns
+        -------
+        dict
+            'Buy' and 'Sell' -> (levels, mkt_queue). levels are the
+            (price, ((id, remaining), ...)) of the levels holding orders from the
+            lowest price, mkt_queue the ((id, remaining), ...) of the market orders.
+
+        """
+        snapshot = {}
+        for side_name, side in (("Buy", self.bid), ("Sell", self.ask)):
+            levels = []
+            level = side.extreme_finder(False)
+            while level is not None:
+                if level.top is not None:
+                    levels.append((level.price, level.snapshot()))
+                level = side.next_price(level, "Buy")  # walking up the prices
+            mkt = side.mkt_available
+            snapshot[side_name] = (
+                tuple(levels),
+                () if mkt is None else mkt.snapshot(),
+            )
+        return snapshot
+
+    def stats(self, verify: bool = False) -> dict:
+        """
+        Introspection of the book, O(1) unless verify is set (see Direction.stats)
+
+        Parameters
+        ----------
+        verify : bool, optional
+            recount both sides by walking them. The default is False.
+
+        Returns
+        -------
+        dict
+            stats of the bid and ask sides and approximate bytes of the book,
+            trade statistics and top of book buffer included.
+
+        """
+        bid = self.bid.stats(verify)
+        ask = self.ask.stats(verify)
+        bars = self.trade_stats.bars.values()
+        recorder = 0 if self.recorder is None else self.recorder.data.nbytes
+        return {
+            "bid": bid,
+            "ask": ask,
+            "bytes": object_bytes(self)
+            + bid["bytes"]
+            + ask["bytes"]
+            + sum(sys.getsizeof(column) for column in bars)
+            + recorder,
+        }
+
+    def add_order_to_book(self, order_to_add: Order):
+        """
+        Head function to add order to book
+
+        Parameters
+        ----------
+        order_to_add : order
+
+        Returns
+        -------
+        None.
+
+        """
+        # check if the order is limit as all mkt orders are priced None
+        if not isinstance(order_to_add, Order):
+            raise Exception("order input is not an Order instance")
+        if self.aggregate_sweeps:
+            self.sweep = []
+            self.sweep_order = order_to_add
+        if order_to_add.price:
+            self.run_limit_order(order_to_add)
+        else:
+            self.run_mkt_order(order_to_add)
+        if self.sweep is not None:
+            sweep = self.sweep
+            self.sweep = self.sweep_order = None
+            if sweep:
+                self.report_sweep(order_to_add, sweep)
+        if self.recorder is not None:
+            self.record_top_of_book(order_to_add)
+
+    def record_top_of_book(self, order: Order):
+        """
+        Append the best bid, best ask, their sizes and the last trade to the recorder
+
+        Parameters
+        ----------
+        order : Order
+            order just processed.
+
+        Returns
+        -------
+        None.
+
+        """
+        bid = self.bid.best_level()
+        ask = self.ask.best_level()
+        last = self.trade_stats.last_price
+        self.recorder.record(
+            order.id,
+            np.nan if bid is None else bid.price,
+            0 if bid is None else bid.total_quantity,
+            np.nan if ask is None else ask.price,
+            0 if ask is None else ask.total_quantity,
+            np.nan if last is None else last,
+        )
+
+    def report_sweep(self, order: Order, sweep: list):
+        """
+        Build the events of a sweep in one pass: one FillEvent per resting order
+        and one SweepEvent for the incoming order
+
+        Parameters
+        ----------
+        order : Order
+            incoming order.
+        sweep : list
+            (resting order, price, qty) for each fill of the incoming order.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.fill_callbacks:
+            events = [
+                FillEvent(
+                    resting.id,
+                    resting.ticker,
+                    resting.price,
+                    resting.side,
+                    resting.size,
+                    price,
+                    qty,
+                    True,
+                )
+                for resting, price, qty in sweep
+            ]
+            for callback in self.fill_callbacks:
+                for event in events:
+                    callback(event)
+        if self.sweep_callbacks:
+            filled = 0
+            notional = 0.0
+            levels = 0
+            level_price = 0  # no resting price is 0, market orders are None
+            worst_price = sweep[0][1]
+            for resting, price, qty in sweep:
+                filled += qty
+                notional += price * qty
+                if resting.price != level_price:
+                    levels += 1
+                    level_price = resting.price
+                if order.side == "Buy":
+                    worst_price = max(worst_price, price)
+                else:
+                    worst_price = min(worst_price, price)
+            event = SweepEvent(
+                order.id,
+                order.ticker,
+                order.price,
+                order.side,
+                order.size,
+                filled,
+                notional / filled,
+                levels,
+                worst_price,
+            )
+            for callback in self.sweep_callbacks:
+                callback(event)
+
+    def run_limit_order(self, limit_order: Order):
+        """
+        Will run the trade if liquidity is found (ask higher than order price or bid lower than order price)
+        We will maintain the price priority when buy orders for example are posted higher than 2 current limit
+        Parameters
+        ----------
+        limit_order : limit Order
+
+        Returns
+        -------
+        None.
+
+        """
+        if not isinstance(limit_order, Order):
+            raise Exception("limit_order input not an Order instance")
+        if limit_order.side == "Buy":
+            best_level = self.ask.extreme_finder(
+                False
+            )  # finding the minimum price on the ask side
+            mkt_orders = (
+                self.ask.mkt_available
+            )  # checking that there is no mkt orders with high time priority (eventhough there shouldn't be)
+            mkt_queue = (
+                self.bid.mkt_available
+            )  # market order sitting there because no price
+            # as the limit order would be filled on the spot if a mkt is standing
+            direction = self.bid
+        else:
+            best_level = self.bid.extreme_finder(True)  # max price on bid side
+            mkt_orders = self.bid.mkt_available
+            mkt_queue = self.ask.mkt_available
+            direction = self.ask
+        if mkt_orders is not None:
+            if mkt_queue is not None:
+                self.spend_liquidity(mkt_orders, mkt_queue, limit_order.price)
+            # trading market liquidity first
+
+            while (limit_order.remaining > 0) & (mkt_orders.top is not None):
+                self.trade(limit_order, mkt_orders)
+
+        if best_level is not None:
+            if limit_order.side == "Buy":
+                while (limit_order.remaining > 0) and (
+                    best_level.price <= limit_order.price
+                ):
+                    # emptied levels stay in the tree so they are skipped
+                    if best_level.top is not None:
+                        self.trade(limit_order, best_level)
+                    if best_level.top is None:
+                        # switching level
+                        best_level = direction.next_price(best_level, limit_order.side)
+                        if best_level is None:
+                            break
+            else:
+                while (limit_order.remaining > 0) and (
+                    best_level.price >= limit_order.price
+                ):
+                    if best_level.top is not None:
+                        self.trade(limit_order, best_level)
+                    if best_level.top is None:
+                        # switching level
+                        best_level = direction.next_price(best_level, limit_order.side)
+                        if best_level is None:
+                            break
+            if limit_order.remaining > 0:
+                #
+                self.log_limit_order(limit_order)
+        else:
+            self.log_limit_order(limit_order)
+            # trade level and go up levels
+
+    def spend_liquidity(self, mkt_orders: Level, mkt_queue: Level, price: float):
+        """
+        Consume the mkt books once a price as come in
+
+        Parameters
+        ----------
+        mkt_order : Mkt order Level
+
+        mkt_queue : Mkt order Level (other side of the book)
+
+        price : price discovered by the arrived limit price
+
+
+        Returns
+        -------
+        None.
+
+        """
+        if mkt_queue is not None:
+            if not isinstance(mkt_queue, Level):
+                raise Exception("mkt_queue is not Level instance")
+        if mkt_orders is not None:
+            if not isinstance(mkt_orders, Level):
+                raise Exception("mkt_orders is not Level instance")
+        # both queues cross for the smallest of their totals, taken off their fronts
+        matched = min(mkt_orders.total_quantity, mkt_queue.total_quantity)
+        orders_slices = mkt_orders.consume(matched)
+        queue_slices = mkt_queue.consume(matched)
+        # pairing the two allocations, one fill each time both sides overlap
+        fills = []
+        if matched > 0:
+            # both allocations sum to matched so they run out together
+            orders_slices, queue_slices = iter(orders_slices), iter(queue_slices)
+            order, orders_left = next(orders_slices)
+            other, queue_left = next(queue_slices)
+            while True:
+                qty = orders_left if orders_left < queue_left else queue_left
+                # respecting time priority in display
+                if order.id > other.id:
+                    fills.append((order, other, qty))
+                else:
+                    fills.append((other, order, qty))
+                orders_left -= qty
+                queue_left -= qty
+                if orders_left == 0:
+                    order, orders_left = next(orders_slices, (None, 0))
+                if queue_left == 0:
+                    other, queue_left = next(queue_slices, (None, 0))
+                if order is None:
+                    break
+        self.output_fills(fills, price)
+        if (matched > 0) and self.level_callbacks:
+            self.level_change(mkt_orders)
+            self.level_change(mkt_queue)
+
+    def trade(self, client_order: Order, level_order: Level):
+        """
+        Matching orders
+
+        Parameters
+        ----------
+        client_order : Order
+            DESCRIPTION.
+        level_order : Level
+            DESCRIPTION.
+
+        Returns
+        -------
+        level_order : TYPE
+            DESCRIPTION.
+
+        """
+        if not isinstance(client_order, Order):
+            raise Exception("client_order is not Order instance")
+        if not isinstance(level_order, Level):
+            raise Exception("level_order is not Level instance")
+
+        if client_order.remaining <= level_order.top.remaining:
+            level_order.top.remaining -= client_order.remaining
+            level_order.reduce(client_order.remaining)
+
+            if client_order.order_type == "MKT":
                 self.output(
                     client_order,
                     level_order.top,
@@ -540,7 +1306,7 @@ class FullBook:
             client_order.remaining = 0
         else:
             client_order.remaining -= level_order.top.remaining
-            level_order.total_quantity -= level_order.top.remaining
+            level_order.reduce(level_order.top.remaining)
             if client_order.order_type == "MKT":
                 self.output(
                     client_order,
@@ -557,6 +1323,8 @@ class FullBook:
                 )
             level_order.top.remaining = 0
             level_order.scalp_from_queue()
+        if self.level_callbacks:
+            self.level_change(level_order)
 
     def run_mkt_order(self, order: Order):
         """
@@ -565,245 +1333,667 @@ class FullBook:
 
         Parameters
         ----------
-        order : MKT order
+        order : MKT order
+
+        Returns
+        -------
+        None.
+
+        """
+        if not isinstance(order, Order):
+            raise Exception("order is not Order instance")
+
+        if order.side == "Buy":
+            best_level = self.ask.extreme_finder(
+                0
+            )  # finding the minimum price on the ask side
+            mkt_orders = (
+                self.bid.mkt_available
+            )  # checking that there is no mkt orders with high time priority (eventhough there shouldn't be)
+            # as the limit order would be filled on the spot if a mkt is standing
+            direction = self.ask
+        else:
+            best_level = self.bid.extreme_finder(1)  # max price on bid side
+            mkt_orders = self.ask.mkt_available
+            direction = self.bid
+
+        if (mkt_orders is None) or (mkt_orders.top is None):
+            if best_level is not None:
+                # keep running while order is not fill completely and there is liquidity
+                while (order.remaining > 0) and (best_level is not None):
+                    # emptied levels stay in the tree so they are skipped
+                    if best_level.top is not None:
+                        self.trade(order, best_level)
+                    if best_level.top is None:
+                        # switching level, None once the whole side is consumed
+                        best_level = direction.next_price(best_level, order.side)
+
+                # we went through the whole liquidity of the other side
+                if order.remaining > 0:
+                    self.log_mkt_order(order)
+            else:
+                # no counterparty so we log
+
+                self.log_mkt_order(order)
+        else:
+            # no time priority so we log (meaning no counterparty too as liquidity should be dried up here)
+
+            self.log_mkt_order(order)
+
+    def log_mkt_order(self, mkt_order: Order):
+        """
+        log the mkt order in the corresponding mkt level
+
+        Parameters
+        ----------
+        mkt_order : MKT Order
+            DESCRIPTION.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not isinstance(mkt_order, Order):
+            raise Exception("mkt_order not Order instance")
+
+        if mkt_order.side == "Buy":
+            level = self.bid.load_Mkt(mkt_order)
+        else:
+            level = self.ask.load_Mkt(mkt_order)
+        if self.level_callbacks:
+            self.level_change(level)
+
+    def log_limit_order(self, limit_order: Order):
+        """
+        log the limit in the corresponding direction and level
+
+        Parameters
+        ----------
+        limit_order : limit Order
+
+        Returns
+        -------
+        None.
+
+        """
+        if not isinstance(limit_order, Order):
+            raise Exception("limit_order not Order instance")
+        if limit_order.side == "Buy":
+            level = self.bid.log_order(limit_order)
+        else:
+            level = self.ask.log_order(limit_order)
+        if self.level_callbacks:
+            self.level_change(level)
+        # self.run_book()
+
+    def output_fills(self, fills: list, price: float):
+        """
+        Send a batch of fills at the same price to the fill subscribers, the
+        statistics and risk state being updated as for output
+
+        Parameters
+        ----------
+        fills : list
+            (client order, book side order, qty) in the order of the trades.
+        price : float
+
+        Returns
+        -------
+        None.
+
+        """
+        if not fills:
+            return None
+        try:
+            price / 2
+        except:
+            raise Exception("Price must be numerical")
+        total = sum(qty for _, _, qty in fills)
+        self.trade_stats.update(price, total, len(fills))
+        if self.risk_state is not None:
+            self.risk_state.fill(price, total)
+        if self.fill_callbacks:
+            events = []
+            for client_order, book_side, qty in fills:
+                events.append(
+                    FillEvent(
+                        book_side.id,
+                        book_side.ticker,
+                        book_side.price,
+                        book_side.side,
+                        book_side.size,
+                        price,
+                        qty,
+                        True,
+                    )
+                )
+                events.append(
+                    FillEvent(
+                        client_order.id,
+                        client_order.ticker,
+                        client_order.price,
+                        client_order.side,
+                        client_order.size,
+                        price,
+                        qty,
+                        False,
+                    )
+                )
+            for event in events:
+                for callback in self.fill_callbacks:
+                    callback(event)
+
+    def output(self, client_order: Order, book_side: Order, price: float, qty: int):
+        """
+        Send both sides of a trade to the fill subscribers
+
+        Parameters
+        ----------
+        client_order : Order
+        book_side : Order
+
+        Returns
+        -------
+        None.
+
+        """
+        if not isinstance(client_order, Order):
+            raise Exception("client_order is not Order instance")
+        if not isinstance(book_side, Order):
+            raise Exception("book_side is not Order instance")
+        try:
+            price / 2
+        except:
+            raise Exception("Price must be numerical")
+        try:
+            qty = int(qty)
+        except:
+            raise Exception("qty must be an int. Float will be truncated to lower int")
+
+        self.trade_stats.update(price, qty)
+        if self.risk_state is not None:
+            self.risk_state.fill(price, qty)
+        if client_order is self.sweep_order:
+            # reported at the end of the sweep by report_sweep
+            self.sweep.append((book_side, price, qty))
+            return
+        if self.fill_callbacks:
+            resting = FillEvent(
+                book_side.id,
+                book_side.ticker,
+                book_side.price,
+                book_side.side,
+                book_side.size,
+                price,
+                qty,
+                True,
+            )
+            aggressive = FillEvent(
+                client_order.id,
+                client_order.ticker,
+                client_order.price,
+                client_order.side,
+                client_order.size,
+                price,
+                qty,
+                False,
+            )
+            for callback in self.fill_callbacks:
+                callback(resting)
+                callback(aggressive)
+
+
+class CsvLogger:
+    """
+    Default subscriber printing the events and logging them in csv files
+    """
+
+    fieldnames = [
+        "ActionType",
+        "OrderId",
+        "Symbol",
+        "Price",
+        "Side",
+        "OrderQuantity",
+        "FillPrice",
+        "FillQuantity",
+        "Reason",
+    ]
+
+    def __init__(
+        self,
+        log_path: str = "Matching_Logs.csv",
+        resting_log_path: str = "Logs.csv",
+        verbose: bool = True,
+    ):
+        """
+
+        Parameters
+        ----------
+        log_path : str, optional
+            csv receiving the acks, rejects and the fills of incoming orders.
+            It is truncated. The default is "Matching_Logs.csv".
+        resting_log_path : str, optional
+            csv receiving the fills of the orders resting in the book.
+            It is truncated. The default is "Logs.csv".
+        verbose : bool, optional
+            print the events as well. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.log_path = log_path
+        self.resting_log_path = resting_log_path
+        self.verbose = verbose
+        for path in (self.log_path, self.resting_log_path):
+            with open(path, "w") as f:
+                writer = csv.writer(f)
+                writer.writerow(self.fieldnames)
+                f.close()
+
+    def ack(self, event: AckEvent):
+        """
+        Print and log an AckEvent
+
+        Returns
+        -------
+        None.
+
+        """
+        price = "MKT" if event.price is None else event.price
+        if self.verbose:
+            print(
+                "Ack", event.order_id, event.symbol, price, event.side, event.quantity
+            )
+        with open(self.log_path, "a") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                ["Ack", event.order_id, event.symbol, price, event.side, event.quantity]
+            )
+            f.close()
+
+    def reject(self, event: RejectEvent):
+        """
+        Print and log a RejectEvent
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.verbose:
+            print(
+                "Reject",
+                event.order_id,
+                event.symbol,
+                event.price,
+                event.side,
+                event.quantity,
+            )
+            print("Reason: " + event.reason)
+        with open(self.log_path, "a") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                [
+                    "Reject",
+                    event.order_id,
+                    event.symbol,
+                    event.price,
+                    event.side,
+                    event.quantity,
+                    None,
+                    None,
+                    event.reason,
+                ]
+            )
+            f.close()
+
+    def fill(self, event: FillEvent):
+        """
+        Print and log a FillEvent, resting orders go to their own file
+
+        Returns
+        -------
+        None.
+
+        """
+        row = [
+            "Fill",
+            event.order_id,
+            event.symbol,
+            "MKT" if event.price is None else event.price,
+            event.side,
+            event.quantity,
+            event.fill_price,
+            event.fill_quantity,
+        ]
+        if self.verbose:
+            print(*row)
+        with open(self.resting_log_path if event.resting else self.log_path, "a") as f:
+            writer = csv.writer(f)
+            writer.writerow(row)
+            f.close()
+
+    def sweep(self, event: SweepEvent):
+        """
+        Print and log a SweepEvent as a SweepFill row at the VWAP, the levels touched
+        and the worst price going in the Reason column
+
+        Returns
+        -------
+        None.
+
+        """
+        row = [
+            "SweepFill",
+            event.order_id,
+            event.symbol,
+            "MKT" if event.price is None else event.price,
+            event.side,
+            event.quantity,
+            event.vwap,
+            event.filled_quantity,
+            "levels: %d, worst price: %s" % (event.levels, event.worst_price),
+        ]
+        if self.verbose:
+            print(*row)
+        with open(self.log_path, "a") as f:
+            writer = csv.writer(f)
+            writer.writerow(row)
+            f.close()
+
+
+class MatchingEngine:
+    """
+    Matching engine dispatch the orders from csv to books and run books
+    """
+
+    # class of the books, alternative book backends subclass the engine to replace it
+    book_class = FullBook
+
+    def __init__(
+        self,
+        sink=None,
+        text_logs: bool = True,
+        aggregate_sweeps: bool = False,
+        bar_interval: float = 60.0,
+        risk=None,
+        reject_duplicates: bool = True,
+        max_idle_books: int = None,
+        log_dir: str = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        sink : event sink, optional
+            object with ack, reject and fill methods receiving the typed events,
+            e.g. event_sink.ColumnarEventSink. The default is None.
+        text_logs : bool, optional
+            subscribe a CsvLogger printing the events and logging them in
+            Matching_Logs.csv. The default is True.
+        aggregate_sweeps : bool, optional
+            aggregated fill reporting of the books (see FullBook). The default is False.
+        bar_interval : float, optional
+            length in seconds of the OHLCV bars of the books. The default is 60.
+        risk : risk.PreTradeRisk, optional
+            pre-trade risk stage run after the checks of clean_and_ack.
+            The default is None.
+        reject_duplicates : bool, optional
+            reject the orders reusing the OrderID of an accepted order, the ids are
+            kept in an order_ids.OrderIdIndex. The default is True.
+        max_idle_books : int, optional
+            number of empty books kept alive, past it the least recently used empty
+            books are evicted and recreated when their symbol comes back.
+            The default is None, books are never evicted.
+        log_dir : str, optional
+            directory of the csv files of text_logs, created if needed.
+            The default is None, the working directory.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.books = {}
+        # subscribers, events are only built when the lists are not empty
+        self.ack_callbacks = []
+        self.reject_callbacks = []
+        self.fill_callbacks = []
+        self.level_callbacks = []
+        self.sweep_callbacks = []
+        self.aggregate_sweeps = aggregate_sweeps
+        self.bar_interval = bar_interval
+        self.recorder_options = None  # see record_top_of_book
+        self.risk = risk
+        self.batch_risk = None  # reject reasons of the batch being loaded
+        self.batch_references = None  # reference prices they were computed against
+        self.order_ids = OrderIdIndex() if reject_duplicates else None
+        # held from the duplicate check to the recording of the id, a lock when
+        # the index is shared by the engines of a ConcurrentEngine
+        self.order_ids_lock = nullcontext()
+        self.max_idle_books = max_idle_books
+        self.idle_books = OrderedDict()  # LRU of the empty books, oldest first
+        # ticker -> (trade_stats, recorder) of the evicted books holding data, the
+        # books without trades nor recorder are only counted in evictions
+        self.evicted = {}
+        self.evictions = 0
+        self.rematerializations = 0
+        if text_logs:
+            if log_dir is None:
+                self.add_sink(CsvLogger())
+            else:
+                os.makedirs(log_dir, exist_ok=True)
+                self.add_sink(
+                    CsvLogger(
+                        os.path.join(log_dir, "Matching_Logs.csv"),
+                        os.path.join(log_dir, "Logs.csv"),
+                    )
+                )
+        if sink is not None:
+            self.add_sink(sink)
+
+    def on_ack(self, callback):
+        """
+        Register a callback receiving an AckEvent for every accepted order
+
+        Parameters
+        ----------
+        callback : callable
+
+        Returns
+        -------
+        None.
+
+        """
+        self.ack_callbacks.append(callback)
+
+    def on_reject(self, callback):
+        """
+        Register a callback receiving a RejectEvent for every rejected order
+
+        Parameters
+        ----------
+        callback : callable
+
+        Returns
+        -------
+        None.
+
+        """
+        self.reject_callbacks.append(callback)
+
+    def on_fill(self, callback):
+        """
+        Register a fill callback on every book, current and future (see FullBook.on_fill)
+
+        Parameters
+        ----------
+        callback : callable
 
         Returns
         -------
         None.
 
         """
-        if not isinstance(order, Order):
-            raise Exception("order is not Order instance")
-
-        if order.side == "Buy":
-            best_level = self.ask.extreme_finder(
-                0
-            )  # finding the minimum price on the ask side
-            mkt_orders = (
-                self.bid.mkt_available
-            )  # checking that there is no mkt orders with high time priority (eventhough there shouldn't be)
-            # as the limit order would be filled on the spot if a mkt is standing
-            direction = self.ask
-        else:
-            best_level = self.bid.extreme_finder(1)  # max price on bid side
-            mkt_orders = self.ask.mkt_available
-            direction = self.bid
-
-        if mkt_orders is None:
-            if best_level is not None:
-                # keep running while order is not fill completely and there is liquidity
-                while (order.remaining > 0) & (best_level is not None):
-                    self.trade(order, best_level)
+        self.fill_callbacks.append(callback)
+        for book in self.books.values():
+            book.on_fill(callback)
 
-                    if (best_level.top is None) & (
-                        direction.next_price(best_level, order.side) is not None
-                    ):
-                        # switching level
-                        best_level = direction.next_price(best_level, order.side)
+    def on_level_change(self, callback):
+        """
+        Register a level callback on every book, current and future
+        (see FullBook.on_level_change)
 
-                # we went through the whole liquidity of the other side
-                if order.remaining > 0:
-                    self.log_mkt_order(order)
-            else:
-                # no counterparty so we log
+        Parameters
+        ----------
+        callback : callable
 
-                self.log_mkt_order(order)
-        else:
-            # no time priority so we log (meaning no counterparty too as liquidity should be dried up here)
+        Returns
+        -------
+        None.
 
-            self.log_mkt_order(order)
+        """
+        self.level_callbacks.append(callback)
+        for book in self.books.values():
+            book.on_level_change(callback)
 
-    def log_mkt_order(self, mkt_order: Order):
+    def on_sweep(self, callback):
         """
-        log the mkt order in the corresponding mkt level
+        Register a sweep callback on every book, current and future
+        (see FullBook.on_sweep)
 
         Parameters
         ----------
-        mkt_order : MKT Order
-            DESCRIPTION.
+        callback : callable
 
         Returns
         -------
         None.
 
         """
-        if not isinstance(mkt_order, Order):
-            raise Exception("mkt_order not Order instance")
-
-        if mkt_order.side == "Buy":
-            self.bid.load_Mkt(mkt_order)
-        else:
-            self.ask.load_Mkt(mkt_order)
+        self.sweep_callbacks.append(callback)
+        for book in self.books.values():
+            book.on_sweep(callback)
 
-    def log_limit_order(self, limit_order: Order):
+    def add_sink(self, sink):
         """
-        log the limit in the corresponding direction and level
+        Subscribe an object with ack, reject, fill and optionally sweep methods to
+        the events (CsvLogger, event_sink.ColumnarEventSink, ring_buffer.RingPublisher)
 
         Parameters
         ----------
-        limit_order : limit Order
+        sink : event sink
 
         Returns
         -------
         None.
 
         """
-        if not isinstance(limit_order, Order):
-            raise Exception("limit_order not Order instance")
-        if limit_order.side == "Buy":
-            self.bid.log_order(limit_order)
-        else:
-            self.ask.log_order(limit_order)
-        # self.run_book()
+        self.on_ack(sink.ack)
+        self.on_reject(sink.reject)
+        self.on_fill(sink.fill)
+        if hasattr(sink, "sweep"):
+            self.on_sweep(sink.sweep)
 
-    def output(self, client_order: Order, book_side: Order, price: float, qty: int):
+    def record_top_of_book(
+        self,
+        capacity: int = 4096,
+        max_capacity: int = 1 << 20,
+        spill_dir: str = None,
+    ):
         """
-        Printing and logging trades in current working directory
+        Attach a TopOfBookRecorder to every book, current and future
 
         Parameters
         ----------
-        client_order : Order
-        book_side : Order
+        capacity : int, optional
+            initial rows of each recorder. The default is 4096.
+        max_capacity : int, optional
+            rows kept in memory before spilling. The default is 1 << 20.
+        spill_dir : str, optional
+            directory of the spill files, created if needed, one <ticker>.tob per
+            book with the ticker percent-encoded (BRK/B gives BRK%2FB.tob).
+            The default is None, the recorders then only grow in memory.
 
         Returns
         -------
         None.
 
         """
-        if not isinstance(client_order, Order):
-            raise Exception("client_order is not Order instance")
-        if not isinstance(book_side, Order):
-            raise Exception("book_side is not Order instance")
-        try:
-            price / 2
-        except:
-            raise Exception("Price must be numerical")
-        try:
-            qty = int(qty)
-        except:
-            raise Exception("qty must be an int. Float will be truncated to lower int")
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.recorder_options = {
+            "capacity": capacity,
+            "max_capacity": max_capacity,
+            "spill_dir": spill_dir,
+        }
+        for ticker, book in self.books.items():
+            book.recorder = self.new_recorder(ticker)
+
+    def new_recorder(self, ticker) -> TopOfBookRecorder:
+        """
+        Recorder of a book following recorder_options
 
-        if book_side.price is not None:
-            print(
-                "Fill",
-                book_side.id,
-                book_side.ticker,
-                book_side.price,
-                book_side.side,
-                book_side.size,
-                price,
-                qty,
-            )
-            row = [
-                "Fill",
-                book_side.id,
-                book_side.ticker,
-                book_side.price,
-                book_side.side,
-                book_side.size,
-                price,
-                qty,
-            ]
-        else:
-            print(
-                "Fill",
-                book_side.id,
-                book_side.ticker,
-                "MKT",
-                book_side.side,
-                book_side.size,
-                price,
-                qty,
-            )
-            row = [
-                "Fill",
-                book_side.id,
-                book_side.ticker,
-                "MKT",
-                book_side.side,
-                book_side.size,
-                price,
-                qty,
-            ]
-        with open("Logs.csv", "a") as f:
-            writer = csv.writer(f)
-            writer.writerow(row)
-            f.close()
+        Parameters
+        ----------
+        ticker : instrument ticker
 
-        if client_order.price is not None:
-            print(
-                "Fill",
-                client_order.id,
-                client_order.ticker,
-                client_order.price,
-                client_order.side,
-                client_order.size,
-                price,
-                qty,
-            )
-            row = [
-                "Fill",
-                client_order.id,
-                client_order.ticker,
-                client_order.price,
-                client_order.side,
-                client_order.size,
-                price,
-                qty,
-            ]
-        else:
-            print(
-                "Fill",
-                client_order.id,
-                client_order.ticker,
-                "MKT",
-                client_order.side,
-                client_order.size,
-                price,
-                qty,
+        Returns
+        -------
+        TopOfBookRecorder
+
+        """
+        options = self.recorder_options
+        spill_path = None
+        if options["spill_dir"] is not None:
+            spill_path = os.path.join(
+                options["spill_dir"], quote(str(ticker), safe="") + ".tob"
             )
-            row = [
-                "Fill",
-                client_order.id,
-                client_order.ticker,
-                "MKT",
-                client_order.side,
-                client_order.size,
-                price,
-                qty,
-            ]
-        with open("Matching_Logs.csv", "a") as f:
-            writer = csv.writer(f)
-            writer.writerow(row)
-            f.close()
+        return TopOfBookRecorder(
+            options["capacity"], options["max_capacity"], spill_path
+        )
 
+    def trade_stats(self) -> np.ndarray:
+        """
+        Snapshot of the trade statistics of every book
 
-class MatchingEngine:
-    """
-    Matching engine dispatch the orders from csv to books and run books
-    """
+        Returns
+        -------
+        np.ndarray
+            structured array with symbol, last_price, vwap (NaN before the first
+            trade), volume and trades.
 
-    def __init__(self):
-        self.books = {}
-        fieldnames = [
-            "ActionType",
-            "OrderId",
-            "Symbol",
-            "Price",
-            "Side",
-            "OrderQuantity",
-            "FillPrice",
-            "FillQuantity",
-            "Reason",
-        ]
-        with open("Matching_Logs.csv", "w") as f:
-            writer = csv.writer(f)
-            writer.writerow(fieldnames)
-            f.close()
+        """
+        all_stats = [(ticker, book.trade_stats) for ticker, book in self.books.items()]
+        for ticker, state in self.evicted.items():
+            all_stats.append((ticker, state[0]))
+        stats = np.zeros(
+            len(all_stats),
+            dtype=[
+                ("symbol", object),
+                ("last_price", "f8"),
+                ("vwap", "f8"),
+                ("volume", "i8"),
+                ("trades", "i8"),
+            ],
+        )
+        for i, (ticker, trade_stats) in enumerate(all_stats):
+            stats[i] = (
+                ticker,
+                np.nan if trade_stats.last_price is None else trade_stats.last_price,
+                np.nan if trade_stats.volume == 0 else trade_stats.vwap,
+                trade_stats.volume,
+                trade_stats.trades,
+            )
+        return stats
 
     def output(self, row: pd.Series, reject: bool = False, reason: str = None):
         """
-        Print and log the designated message in the current working directory
+        Send the ack or reject of an input row to the subscribers
 
         Parameters
         ----------
@@ -817,30 +2007,16 @@ class MatchingEngine:
         None.
 
         """
-
-        with open("Matching_Logs.csv", "a") as f:
-            writer = csv.writer(f)
-            if reject:
-                print("Reject", row[0], row[1], row[2], row[3], row[4])
-                print("Reason: " + reason)
-                writer.writerow(
-                    [
-                        "Reject",
-                        row[0],
-                        row[1],
-                        row[2],
-                        row[3],
-                        row[4],
-                        None,
-                        None,
-                        reason,
-                    ]
-                )
-
-            else:
-                print("Ack", row[0], row[1], row[2], row[3], row[4])
-                writer.writerow(["Ack", row[0], row[1], row[2], row[3], row[4]])
-            f.close()
+        if reject:
+            if self.reject_callbacks:
+                event = RejectEvent(row[0], row[1], row[2], row[3], row[4], reason)
+                for callback in self.reject_callbacks:
+                    callback(event)
+        elif self.ack_callbacks:
+            price = None if row[2] == "MKT" else row[2]
+            event = AckEvent(row[0], row[1], price, row[3], row[4])
+            for callback in self.ack_callbacks:
+                callback(event)
 
     def add_book(self, ticker):
         """
@@ -856,10 +2032,138 @@ class MatchingEngine:
 
         """
         if ticker not in self.books.keys():
-            self.books[ticker] = FullBook(ticker)
+            book = self.book_class(ticker, self.aggregate_sweeps, self.bar_interval)
+            book.fill_callbacks.extend(self.fill_callbacks)
+            book.level_callbacks.extend(self.level_callbacks)
+            book.sweep_callbacks.extend(self.sweep_callbacks)
+            if ticker in self.evicted:
+                # rematerializing an evicted book with its history
+                book.trade_stats, book.recorder = self.evicted.pop(ticker)
+                self.rematerializations += 1
+            if (book.recorder is None) and (self.recorder_options is not None):
+                # a new recorder truncates the spill file of the ticker
+                book.recorder = self.new_recorder(ticker)
+            if self.risk is not None:
+                book.risk_state = self.risk.state(ticker)
+            self.books[ticker] = book
         else:
             print(ticker, "already found in books")
 
+    def evict_book(self, ticker):
+        """
+        Drop an empty book, its trade statistics and top of book history are kept
+        aside and handed back to the book recreated by add_book
+
+        Parameters
+        ----------
+        ticker : instrument ticker
+
+        Returns
+        -------
+        None.
+
+        """
+        book = self.books[ticker]
+        if not book.is_empty():
+            raise Exception(str(ticker) + " book still holds orders")
+        del self.books[ticker]
+        self.idle_books.pop(ticker, None)
+        if (book.trade_stats.trades > 0) or (book.recorder is not None):
+            self.evicted[ticker] = (book.trade_stats, book.recorder)
+        self.evictions += 1
+
+    def touch_book(self, ticker):
+        """
+        Update the idle LRU after an order of the book and evict the least
+        recently used empty books past max_idle_books
+
+        Parameters
+        ----------
+        ticker : instrument ticker
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.books[ticker].is_empty():
+            self.idle_books[ticker] = None
+            self.idle_books.move_to_end(ticker)
+            while len(self.idle_books) > self.max_idle_books:
+                self.evict_book(next(iter(self.idle_books)))
+        else:
+            self.idle_books.pop(ticker, None)
+
+    def book_counts(self) -> dict:
+        """
+        Live, idle (empty and still alive) and evicted books kept for their
+        history, with the number of evictions and rematerializations so far.
+        An evicted book without trades nor recorder is recreated as a new book.
+
+        Returns
+        -------
+        dict
+
+        """
+        return {
+            "live": len(self.books),
+            "idle": len(self.idle_books),
+            "evicted": len(self.evicted),
+            "evictions": self.evictions,
+            "rematerializations": self.rematerializations,
+        }
+
+    def stats(self, verify: bool = False) -> dict:
+        """
+        Totals of the stats of the live books, with the book counts and the
+        size of the OrderID index
+
+        Parameters
+        ----------
+        verify : bool, optional
+            recount every book by walking it, the books with wrong counters are
+            listed in mismatches. The default is False.
+
+        Returns
+        -------
+        dict
+
+        """
+        totals = {
+            "books": self.book_counts(),
+            "resting_orders": 0,
+            "levels": 0,
+            "live_levels": 0,
+            "empty_levels": 0,
+            "max_height": 0,
+            "mkt_orders": 0,
+            "bytes": 0,
+            "order_ids_bytes": 0,
+        }
+        if self.order_ids is not None:
+            totals["order_ids_bytes"] = self.order_ids.memory_usage()
+        mismatches = {}
+        for ticker, book in self.books.items():
+            book_stats = book.stats(verify)
+            totals["bytes"] += book_stats["bytes"]
+            for side in ("bid", "ask"):
+                side_stats = book_stats[side]
+                for name in (
+                    "resting_orders",
+                    "levels",
+                    "live_levels",
+                    "empty_levels",
+                    "mkt_orders",
+                ):
+                    totals[name] += side_stats[name]
+                totals["max_height"] = max(totals["max_height"], side_stats["height"])
+                if verify and side_stats["mismatches"]:
+                    mismatches.setdefault(ticker, {})[side] = side_stats["mismatches"]
+        totals["bytes"] += totals["order_ids_bytes"]
+        if verify:
+            totals["mismatches"] = mismatches
+        return totals
+
     def dispatcher(self, row):
         """
         Assign order to the right book and run it.
@@ -897,6 +2201,8 @@ class MatchingEngine:
             )
         # adding order to book
         self.books[row["Symbol"]].add_order_to_book(order)
+        if self.max_idle_books is not None:
+            self.touch_book(row["Symbol"])
 
     def clean_and_ack(self, row):
         """
@@ -940,6 +2246,13 @@ class MatchingEngine:
                 reason="Can't convert ID to numeric value. Please use numeric vaues as engine use id to assess time priority",
             )
             return None
+        if not (INT64_MIN <= row["OrderID"] <= INT64_MAX):
+            self.output(
+                row=row,
+                reject=True,
+                reason="OrderID must fit in a signed 64 bit integer",
+            )
+            return None
 
         if row["Price"] is not None:
             try:
@@ -977,11 +2290,76 @@ class MatchingEngine:
             )
             return None
 
+        with self.order_ids_lock:
+            if (self.order_ids is not None) and (row["OrderID"] in self.order_ids):
+                reason = DUPLICATE_ID
+            elif self.risk is not None:
+                reason = self.check_risk(
+                    row["Symbol"],
+                    row["Price"],
+                    row["Side"],
+                    row["OrderQuantity"],
+                    row.name,
+                )
+            else:
+                reason = None
+            if (reason is None) and (self.order_ids is not None):
+                self.order_ids.add(row["OrderID"])
+        if reason is not None:
+            self.output(row=row, reject=True, reason=reason)
+            return None
+
         self.output(row=row, reject=False)
         self.dispatcher(row)
         return None
 
-    def load(self, file_path: str = None, df: pd.DataFrame = None):
+    def check_risk(self, symbol, price, side: str, qty: int, batch_row=None) -> str:
+        """
+        Run the pre-trade risk stage on a cleaned order and account for it if it passes
+
+        Parameters
+        ----------
+        symbol : str
+        price : float or 'MKT'
+        side : str
+        qty : int
+        batch_row : int, optional
+            position of the order in the batch being loaded, its price collar and
+            notional were then already checked by PreTradeRisk.check_batch, unless
+            the reference price of the symbol moved since the start of the batch.
+            The default is None.
+
+        Returns
+        -------
+        str
+            reject reason, None if the order passes.
+
+        """
+        book = self.books.get(symbol)
+        if (self.batch_risk is not None) and (batch_row is not None):
+            reference = self.risk.reference_price(symbol, book)
+            if reference == self.batch_references.get(symbol):
+                reason = self.batch_risk[batch_row]
+                if reason is None:
+                    reason = self.risk.check_position(
+                        symbol, price, side, qty, reference
+                    )
+            else:
+                # trades of the batch moved the reference, the prefilter is stale
+                reason = self.risk.check_price(symbol, price, qty, reference)
+                if reason is None:
+                    reason = self.risk.check_position(
+                        symbol, price, side, qty, reference
+                    )
+        else:
+            reason = self.risk.check(symbol, price, side, qty, book)
+        if reason is None:
+            self.risk.accept(symbol, side, qty)
+        return reason
+
+    def load(
+        self, file_path: str = None, df: pd.DataFrame = None, verbose: bool = True
+    ):
         """
         Loading csv as pandas df for easier cleaning
         for simplicity we assume that we can sort OrderId alphabetically to get time priority
@@ -989,6 +2367,8 @@ class MatchingEngine:
         Parameters
         ----------
         file_path : String
+        verbose : bool, optional
+            print the head of df. The default is True.
 
         Returns
         -------
@@ -999,8 +2379,81 @@ class MatchingEngine:
             raise Exception("No data or path provided")
         elif df is None:
             df = pd.read_csv(file_path, sep=";")
-        else:
+        elif verbose:
             print(df.head())
 
+        if self.risk is not None:
+            # collars and notional are checked on the whole batch at once
+            df = df.reset_index(drop=True)
+            self.batch_risk = self.risk.check_batch(df, self.books).to_numpy()
+            self.batch_references = {
+                symbol: self.risk.reference_price(symbol, self.books.get(symbol))
+                for symbol in df["Symbol"].astype(str).unique()
+            }
         # adopting array format as we want to swipe our data only once, and not slice it through multiple angles
-        df.apply(lambda x: self.clean_and_ack(x), axis=1)
+        try:
+            df.apply(lambda x: self.clean_and_ack(x), axis=1)
+        finally:
+            self.batch_risk = None
+            self.batch_references = None
+
+    def load_binary(self, file_path: str, chunk_size: int = 65536):
+        """
+        Replay a binary order file (see binary_orders) through the engine.
+        The file is memory-mapped and read chunk by chunk, the checks are the ones of
+        clean_and_ack that still apply to typed records.
+
+        Parameters
+        ----------
+        file_path : String
+        chunk_size : int, optional
+            number of records converted at once. The default is 65536.
+
+        Returns
+        -------
+        None.
+
+        """
+        symbols, records = read_orders(file_path)
+        for start in range(0, len(records), chunk_size):
+            for order_id, symbol, side, order_type, price_ticks, quantity in records[
+                start : start + chunk_size
+            ].tolist():
+                if order_type == MARKET:
+                    price = "MKT"
+                else:
+                    price = round(price_ticks * TICK, 1)
+                row = (
+                    order_id,
+                    symbols[symbol],
+                    price,
+                    "Buy" if side == BUY else "Sell",
+                    quantity,
+                )
+                if order_type != MARKET and price < 0:
+                    reason = "Price can't be negative"
+                elif quantity > 1000000:
+                    reason = "Maximum order size is 1000000"
+                elif quantity <= 0:
+                    reason = "OrderQuantity need to be strickly positive"
+                elif (self.order_ids is not None) and (order_id in self.order_ids):
+                    reason = DUPLICATE_ID
+                elif self.risk is not None:
+                    reason = self.check_risk(row[1], row[2], row[3], row[4])
+                else:
+                    reason = None
+                if reason is not None:
+                    self.output(row=row, reject=True, reason=reason)
+                else:
+                    if self.order_ids is not None:
+                        self.order_ids.add(order_id)
+                    self.output(row=row, reject=False)
+                    self.dispatcher(
+                        {
+                            "OrderID": row[0],
+                            "Symbol": row[1],
+                            "Price": row[2],
+                            "Side": row[3],
+                            "OrderQuantity": row[4],
+                        }
+                    )
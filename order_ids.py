@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Compact set of the order ids accepted by the engine
+
+Ids are stored as sorted disjoint [start, end) ranges in typed arrays, a mostly
+increasing id stream collapses into a handful of ranges and the next id of the
+last range is added in O(1). Ids whose range can't be stored in int64 are kept
+in a plain set.
+"""
+
+import sys
+from array import array
+from bisect import bisect_right
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+
+class OrderIdIndex:
+    """
+    Exact membership index of integer order ids
+    """
+
+    def __init__(self):
+        self.starts = array("q")
+        self.ends = array("q")  # exclusive
+        self.overflow = set()  # ids outside [INT64_MIN, INT64_MAX)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, order_id: int) -> bool:
+        if not (INT64_MIN <= order_id < INT64_MAX):
+            return order_id in self.overflow
+        ends = self.ends
+        if (not ends) or (order_id >= ends[-1]):
+            return False
+        i = bisect_right(self.starts, order_id) - 1
+        return (i >= 0) and (order_id < ends[i])
+
+    def add(self, order_id: int) -> bool:
+        """
+        Add an id to the index
+
+        Parameters
+        ----------
+        order_id : int
+
+        Returns
+        -------
+        bool
+            False if the id was already in the index.
+
+        """
+        if not (INT64_MIN <= order_id < INT64_MAX):
+            if order_id in self.overflow:
+                return False
+            self.overflow.add(order_id)
+            self.count += 1
+            return True
+        starts, ends = self.starts, self.ends
+        if ends and (order_id == ends[-1]):
+            # next id of the last range, the usual case
+            ends[-1] += 1
+            self.count += 1
+            return True
+        if (not ends) or (order_id > ends[-1]):
+            starts.append(order_id)
+            ends.append(order_id + 1)
+            self.count += 1
+            return True
+
+        i = bisect_right(starts, order_id) - 1
+        if (i >= 0) and (order_id < ends[i]):
+            return False
+        if (i >= 0) and (ends[i] == order_id):
+            # extending the range on the left, merging it with the next one if they touch
+            ends[i] += 1
+            if (i + 1 < len(starts)) and (starts[i + 1] == ends[i]):
+                ends[i] = ends[i + 1]
+                del starts[i + 1]
+                del ends[i + 1]
+        elif (i + 1 < len(starts)) and (starts[i + 1] == order_id + 1):
+            starts[i + 1] = order_id
+        else:
+            starts.insert(i + 1, order_id)
+            ends.insert(i + 1, order_id + 1)
+        self.count += 1
+        return True
+
+    def memory_usage(self) -> int:
+        """
+        Approximate bytes used by the index
+
+        Returns
+        -------
+        int
+
+        """
+        return (
+            sys.getsizeof(self.starts)
+            + sys.getsizeof(self.ends)
+            + sys.getsizeof(self.overflow)
+        )
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel replay of daily order files
+
+Each file (csv in the engine input format, or a binary_orders file) is replayed
+in its own MatchingEngine on a process pool, logging into <output_dir>/<day>/.
+A summary of the orders, fills, rejects and throughput of every day is written
+to <output_dir>/summary.csv.
+
+    python replay.py <input_dir> <output_dir> [--workers N]
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from matching_engine import CsvLogger, MatchingEngine
+
+# input formats by file extension
+FORMATS = {".csv": "csv", ".bin": "binary"}
+
+
+class ReplayCounter:
+    """
+    Subscriber counting the events of a replay
+    """
+
+    def __init__(self):
+        self.acks = 0
+        self.rejects = 0
+        self.fills = 0  # trades, the resting side of a fill is not counted
+        self.filled_quantity = 0
+
+    def ack(self, event):
+        self.acks += 1
+
+    def reject(self, event):
+        self.rejects += 1
+
+    def fill(self, event):
+        if not event.resting:
+            self.fills += 1
+            self.filled_quantity += event.fill_quantity
+
+    def sweep(self, event):
+        self.fills += 1
+        self.filled_quantity += event.filled_quantity
+
+
+def replay_file(input_path: str, output_dir: str, engine_options: dict = None) -> dict:
+    """
+    Replay one file in a fresh engine
+
+    Parameters
+    ----------
+    input_path : str
+    output_dir : str
+        the logs go to output_dir/<file name without extension>/.
+    engine_options : dict, optional
+        keyword arguments of MatchingEngine. The default is None.
+
+    Returns
+    -------
+    dict
+        summary of the day.
+
+    """
+    day, extension = os.path.splitext(os.path.basename(input_path))
+    if extension not in FORMATS:
+        raise Exception("unsupported input format " + extension)
+    log_dir = os.path.join(output_dir, day)
+    os.makedirs(log_dir, exist_ok=True)
+
+    engine = MatchingEngine(text_logs=False, **(engine_options or {}))
+    engine.add_sink(
+        CsvLogger(
+            os.path.join(log_dir, "Matching_Logs.csv"),
+            os.path.join(log_dir, "Logs.csv"),
+            verbose=False,
+        )
+    )
+    counter = ReplayCounter()
+    engine.add_sink(counter)
+
+    start = time.perf_counter()
+    if FORMATS[extension] == "csv":
+        engine.load(file_path=input_path)
+    else:
+        engine.load_binary(input_path)
+    seconds = time.perf_counter() - start
+
+    orders = counter.acks + counter.rejects
+    return {
+        "day": day,
+        "orders": orders,
+        "acks": counter.acks,
+        "rejects": counter.rejects,
+        "fills": counter.fills,
+        "filled_quantity": counter.filled_quantity,
+        "seconds": seconds,
+        "orders_per_second": orders / seconds if seconds > 0 else float("nan"),
+    }
+
+
+def replay(
+    input_dir: str,
+    output_dir: str,
+    workers: int = None,
+    engine_options: dict = None,
+) -> pd.DataFrame:
+    """
+    Replay every supported file of input_dir, one process per file
+
+    Parameters
+    ----------
+    input_dir : str
+    output_dir : str
+    workers : int, optional
+        size of the process pool. The default is None, one per core.
+    engine_options : dict, optional
+        keyword arguments of the engines. The default is None.
+
+    Returns
+    -------
+    pd.DataFrame
+        summary of every day, sorted by file name, also written to
+        output_dir/summary.csv.
+
+    """
+    paths = sorted(
+        os.path.join(input_dir, name)
+        for name in os.listdir(input_dir)
+        if os.path.splitext(name)[1] in FORMATS
+    )
+    if not paths:
+        raise Exception("no order file found in " + input_dir)
+    days = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    shared = sorted(set(day for day in days if days.count(day) > 1))
+    if shared:
+        # they would log into the same <output_dir>/<day>/ directory
+        raise Exception("several order files for the days " + ", ".join(shared))
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        days = list(
+            pool.map(
+                replay_file,
+                paths,
+                [output_dir] * len(paths),
+                [engine_options] * len(paths),
+            )
+        )
+    summary = pd.DataFrame(days)
+    summary.to_csv(os.path.join(output_dir, "summary.csv"), index=False)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("input_dir", help="directory of the daily order files")
+    parser.add_argument("output_dir", help="directory receiving the logs")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="processes, one per core by default"
+    )
+    args = parser.parse_args(argv)
+    summary = replay(args.input_dir, args.output_dir, args.workers)
+    print(summary.to_string(index=False))
+    total_orders = summary["orders"].sum()
+    print(
+        "%d days, %d orders, %d fills, %d rejects"
+        % (len(summary), total_orders, summary["fills"].sum(), summary["rejects"].sum())
+    )
+
+
+if __name__ == "__main__":
+    main()
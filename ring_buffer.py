@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory ring buffer publishing the engine events to local consumers
+
+One publisher (the engine) writes fixed-size event records in a
+multiprocessing.shared_memory block, any number of consumers in other processes
+read them by sequence number and detect when they have been lapped by the publisher.
+"""
+
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from event_sink import ACK, FILL, REJECT, SWEEP, _as_float, _as_int
+from matching_engine import AckEvent, FillEvent, RejectEvent, SweepEvent
+
+HEADER_SIZE = 64  # capacity and published sequence, padded to a cache line
+BUY, SELL, OTHER_SIDE = 1, 0, 255
+# bits of the truncated field
+SYMBOL_TRUNCATED, REASON_TRUNCATED = 1, 2
+SYMBOL_SIZE, REASON_SIZE = 16, 112
+
+# records are one cache line multiple, every reject reason of the engine fits.
+# Longer symbols and reasons are cut on a character boundary and flagged in
+# truncated. Sweeps carry their VWAP and filled quantity in fill_price and
+# fill_quantity.
+RECORD_DTYPE = np.dtype(
+    {
+        "names": [
+            "seq",
+            "kind",
+            "side",
+            "resting",
+            "truncated",
+            "levels",
+            "order_id",
+            "symbol",
+            "price",
+            "quantity",
+            "fill_price",
+            "fill_quantity",
+            "reason",
+            "worst_price",
+        ],
+        "formats": [
+            "<i8",
+            "u1",
+            "u1",
+            "u1",
+            "u1",
+            "<u4",
+            "<i8",
+            "S%d" % SYMBOL_SIZE,
+            "<f8",
+            "<f8",
+            "<f8",
+            "<i8",
+            "S%d" % REASON_SIZE,
+            "<f8",
+        ],
+        "offsets": [0, 8, 9, 10, 11, 12, 16, 24, 40, 48, 56, 64, 72, 184],
+        "itemsize": 192,
+    }
+)
+
+
+def _encode(text: str, size: int):
+    """
+    utf-8 bytes of a text cut to size on a character boundary
+
+    Returns
+    -------
+    tuple
+        (bytes, whether the text was cut).
+
+    """
+    encoded = text.encode("utf-8")
+    if len(encoded) <= size:
+        return encoded, False
+    return encoded[:size].decode("utf-8", "ignore").encode("utf-8"), True
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to an existing block without letting the resource tracker of this
+    process unlink it at exit (the publisher owns it)
+
+    Parameters
+    ----------
+    name : str
+
+    Returns
+    -------
+    shared_memory.SharedMemory
+
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13 has no track argument, skip the registration
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class RingPublisher:
+    """
+    Single producer side of the ring buffer, usable as the engine event sink:
+    MatchingEngine(sink=RingPublisher(...))
+    """
+
+    def __init__(self, name: str = None, capacity: int = 65536):
+        """
+
+        Parameters
+        ----------
+        name : str, optional
+            name of the shared memory block. The default is a generated name.
+        capacity : int, optional
+            number of records kept before the oldest is overwritten. The default is 65536.
+
+        Returns
+        -------
+        None.
+
+        """
+        if capacity <= 0:
+            raise Exception("capacity must be strictly positive")
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=True, size=HEADER_SIZE + capacity * RECORD_DTYPE.itemsize
+        )
+        self.name = self.shm.name
+        self.header = np.ndarray((2,), dtype="<i8", buffer=self.shm.buf)
+        self.records = np.ndarray(
+            (capacity,), dtype=RECORD_DTYPE, buffer=self.shm.buf, offset=HEADER_SIZE
+        )
+        self.header[0] = capacity
+        self.header[1] = 0  # number of records published
+        self.sequence = 0
+        self.truncated = 0  # records published with a truncated symbol or reason
+
+    def publish(
+        self,
+        kind: int,
+        order_id,
+        symbol,
+        price,
+        side,
+        quantity,
+        fill_price=None,
+        fill_quantity: int = 0,
+        reason: str = None,
+        resting: bool = False,
+        levels: int = 0,
+        worst_price=None,
+    ):
+        """
+        Write one record in the next slot then publish its sequence number.
+        The slot sequence is written last so a consumer can tell a finished record
+        from one being overwritten.
+
+        Returns
+        -------
+        None.
+
+        """
+        slot = self.records[self.sequence % self.capacity]
+        slot["seq"] = 0
+        slot["kind"] = kind
+        slot["side"] = BUY if side == "Buy" else SELL if side == "Sell" else OTHER_SIDE
+        slot["order_id"] = _as_int(order_id)
+        symbol, symbol_cut = _encode(str(symbol), SYMBOL_SIZE)
+        reason, reason_cut = (
+            (b"", False) if reason is None else _encode(reason, REASON_SIZE)
+        )
+        slot["symbol"] = symbol
+        slot["price"] = _as_float(price)
+        slot["quantity"] = _as_float(quantity)
+        slot["fill_price"] = _as_float(fill_price)
+        slot["fill_quantity"] = fill_quantity
+        slot["reason"] = reason
+        slot["truncated"] = (SYMBOL_TRUNCATED if symbol_cut else 0) | (
+            REASON_TRUNCATED if reason_cut else 0
+        )
+        self.truncated += symbol_cut or reason_cut
+        slot["resting"] = resting
+        slot["levels"] = levels
+        slot["worst_price"] = _as_float(worst_price)
+        self.sequence += 1
+        slot["seq"] = self.sequence
+        self.header[1] = self.sequence
+
+    def ack(self, event):
+        """Publish an AckEvent"""
+        self.publish(
+            ACK, event.order_id, event.symbol, event.price, event.side, event.quantity
+        )
+
+    def reject(self, event):
+        """Publish a RejectEvent"""
+        self.publish(
+            REJECT,
+            event.order_id,
+            event.symbol,
+            event.price,
+            event.side,
+            event.quantity,
+            reason=event.reason,
+        )
+
+    def fill(self, event):
+        """Publish a FillEvent"""
+        self.publish(
+            FILL,
+            event.order_id,
+            event.symbol,
+            event.price,
+            event.side,
+            event.quantity,
+            event.fill_price,
+            event.fill_quantity,
+            resting=event.resting,
+        )
+
+    def sweep(self, event):
+        """Publish a SweepEvent"""
+        self.publish(
+            SWEEP,
+            event.order_id,
+            event.symbol,
+            event.price,
+            event.side,
+            event.quantity,
+            event.vwap,
+            event.filled_quantity,
+            levels=event.levels,
+            worst_price=event.worst_price,
+        )
+
+    def close(self, unlink: bool = True):
+        """
+        Release the shared memory, unlinking it unless consumers should keep it
+
+        Parameters
+        ----------
+        unlink : bool, optional
+            The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        del self.header, self.records
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class RingConsumer:
+    """
+    Consumer side of the ring buffer, each consumer keeps its own position
+    """
+
+    def __init__(self, name: str, from_start: bool = True):
+        """
+
+        Parameters
+        ----------
+        name : str
+            name of the publisher shared memory block.
+        from_start : bool, optional
+            start at the oldest record still in the ring, otherwise only new records
+            are read. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.shm = _attach(name)
+        self.header = np.ndarray((2,), dtype="<i8", buffer=self.shm.buf)
+        self.capacity = int(self.header[0])
+        self.records = np.ndarray(
+            (self.capacity,),
+            dtype=RECORD_DTYPE,
+            buffer=self.shm.buf,
+            offset=HEADER_SIZE,
+        )
+        published = int(self.header[1])
+        if from_start:
+            self.sequence = max(0, published - self.capacity)
+        else:
+            self.sequence = published
+        self.overruns = 0  # number of records lost because the publisher lapped us
+        self.truncated = 0  # events read with a truncated symbol or reason
+
+    def poll_records(self, max_records: int = None) -> np.ndarray:
+        """
+        Copy the records published since the last poll.
+        Records overwritten before or while being copied are skipped and counted
+        in overruns.
+
+        Parameters
+        ----------
+        max_records : int, optional
+            The default is all available records.
+
+        Returns
+        -------
+        np.ndarray
+            structured array with RECORD_DTYPE, ordered by sequence.
+
+        """
+        published = int(self.header[1])
+        if published - self.sequence > self.capacity:
+            self.overruns += published - self.capacity - self.sequence
+            self.sequence = published - self.capacity
+        end = published
+        if max_records is not None:
+            end = min(end, self.sequence + max_records)
+        sequences = np.arange(self.sequence, end, dtype=np.int64)
+        slots = sequences % self.capacity
+        batch = self.records[slots]  # fancy indexing copies
+        # the publisher zeroes a slot sequence before rewriting it, so a record is
+        # intact if its sequence is the expected one both before and after the copy
+        valid = (batch["seq"] == sequences + 1) & (
+            self.records["seq"][slots] == sequences + 1
+        )
+        invalid = np.flatnonzero(~valid)
+        if len(invalid):
+            lost = int(invalid[-1]) + 1  # the oldest records are the ones overwritten
+            self.overruns += lost
+            batch = batch[lost:]
+        self.sequence = end
+        return batch
+
+    def poll(self, max_records: int = None) -> list:
+        """
+        Events published since the last poll
+
+        Parameters
+        ----------
+        max_records : int, optional
+            The default is all available records.
+
+        Returns
+        -------
+        list of (sequence, event)
+            event is an AckEvent, RejectEvent, FillEvent or SweepEvent. Events
+            whose symbol or reason was truncated are counted in truncated, see
+            the truncated field of poll_records for which one.
+
+        """
+        events = []
+        for (
+            seq,
+            kind,
+            side,
+            resting,
+            truncated,
+            levels,
+            order_id,
+            symbol,
+            price,
+            quantity,
+            fill_price,
+            fill_quantity,
+            reason,
+            worst_price,
+        ) in self.poll_records(max_records).tolist():
+            if truncated:
+                self.truncated += 1
+            symbol = symbol.decode("utf-8")
+            side = "Buy" if side == BUY else "Sell" if side == SELL else None
+            price = None if price != price else price  # NaN for market orders
+            if kind == FILL:
+                event = FillEvent(
+                    order_id,
+                    symbol,
+                    price,
+                    side,
+                    int(quantity),
+                    fill_price,
+                    fill_quantity,
+                    bool(resting),
+                )
+            elif kind == ACK:
+                event = AckEvent(order_id, symbol, price, side, int(quantity))
+            elif kind == SWEEP:
+                event = SweepEvent(
+                    order_id,
+                    symbol,
+                    price,
+                    side,
+                    int(quantity),
+                    fill_quantity,
+                    fill_price,
+                    levels,
+                    worst_price,
+                )
+            else:
+                event = RejectEvent(
+                    order_id, symbol, price, side, quantity, reason.decode("utf-8")
+                )
+            events.append((seq, event))
+        return events
+
+    def close(self):
+        """
+        Detach from the shared memory
+
+        Returns
+        -------
+        None.
+
+        """
+        del self.header, self.records
+        self.shm.close()
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-trade risk checks of the matching engine
+
+Dynamic price collars around the reference price of each symbol (last trade, or mid
+when nothing traded yet), maximum notional per order and per-symbol limits on the
+open quantity (position) and open notional (exposure) of each side.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class SymbolRisk:
+    """
+    Risk state of one symbol, the reference price and the open quantities are
+    updated by the book on each fill
+    """
+
+    __slots__ = ("reference", "open_buy", "open_sell")
+
+    def __init__(self):
+        self.reference = None  # last trade price
+        self.open_buy = 0  # accepted quantity not filled yet
+        self.open_sell = 0
+
+    def fill(self, price: float, qty: int):
+        """
+        Account for one trade, each fill has a buy and a sell side
+
+        Parameters
+        ----------
+        price : float
+        qty : int
+
+        Returns
+        -------
+        None.
+
+        """
+        self.reference = price
+        self.open_buy -= qty
+        self.open_sell -= qty
+
+
+class PreTradeRisk:
+    """
+    Pre-trade risk stage, pass it to MatchingEngine(risk=...).
+    Every limit is optional and can be overridden per symbol.
+    """
+
+    limit_names = ("price_band", "max_notional", "max_position", "max_exposure")
+
+    def __init__(
+        self,
+        price_band: float = None,
+        max_notional: float = None,
+        max_position: int = None,
+        max_exposure: float = None,
+        symbol_limits: dict = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        price_band : float, optional
+            maximum relative distance of a limit price to the reference price,
+            0.1 accepts prices within +/- 10%. The default is None.
+        max_notional : float, optional
+            maximum price * quantity of an order, market orders are valued at the
+            reference price. The default is None.
+        max_position : int, optional
+            maximum open quantity of one side of a symbol. The default is None.
+        max_exposure : float, optional
+            maximum open quantity of one side of a symbol valued at the reference
+            price. The default is None.
+        symbol_limits : dict, optional
+            symbol -> {limit name: value} overriding the limits above.
+            The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.limits = {
+            "price_band": price_band,
+            "max_notional": max_notional,
+            "max_position": max_position,
+            "max_exposure": max_exposure,
+        }
+        self.symbol_limits = symbol_limits if symbol_limits is not None else {}
+        for limits in self.symbol_limits.values():
+            for name in limits:
+                if name not in self.limit_names:
+                    raise Exception(name + " is not a risk limit")
+        self.states = {}
+
+    def limit(self, symbol, name: str):
+        """
+        Value of a limit for a symbol, None if it is not checked
+
+        Parameters
+        ----------
+        symbol : str
+        name : str
+
+        Returns
+        -------
+        float
+
+        """
+        limits = self.symbol_limits.get(symbol)
+        if (limits is not None) and (name in limits):
+            return limits[name]
+        return self.limits[name]
+
+    def state(self, symbol) -> SymbolRisk:
+        """
+        Risk state of a symbol, created on first use
+
+        Parameters
+        ----------
+        symbol : str
+
+        Returns
+        -------
+        SymbolRisk
+
+        """
+        state = self.states.get(symbol)
+        if state is None:
+            state = self.states[symbol] = SymbolRisk()
+        return state
+
+    def reference_price(self, symbol, book=None) -> float:
+        """
+        Last trade of the symbol, or the mid of its book when nothing traded yet
+
+        Parameters
+        ----------
+        symbol : str
+        book : FullBook, optional
+            The default is None.
+
+        Returns
+        -------
+        float
+            None when there is no reference.
+
+        """
+        state = self.states.get(symbol)
+        if (state is not None) and (state.reference is not None):
+            return state.reference
+        if book is not None:
+            bid = book.bid.best_level()
+            ask = book.ask.best_level()
+            if (bid is not None) and (ask is not None):
+                return (bid.price + ask.price) / 2
+        return None
+
+    def check_price(self, symbol, price, qty: int, reference: float) -> str:
+        """
+        Price collar and maximum notional of one order
+
+        Parameters
+        ----------
+        symbol : str
+        price : float or 'MKT'
+        qty : int
+        reference : float
+
+        Returns
+        -------
+        str
+            reject reason, None if the order passes.
+
+        """
+        if price == "MKT":
+            price = reference
+        else:
+            band = self.limit(symbol, "price_band")
+            if (band is not None) and (reference is not None):
+                if abs(price - reference) > band * reference:
+                    return "Price outside of the price band around the reference price"
+        max_notional = self.limit(symbol, "max_notional")
+        if (max_notional is not None) and (price is not None):
+            if price * qty > max_notional:
+                return "Order notional above the maximum notional"
+        return None
+
+    def check_position(self, symbol, price, side: str, qty: int, reference: float):
+        """
+        Position and exposure limits of the side of the symbol
+
+        Parameters
+        ----------
+        symbol : str
+        price : float or 'MKT'
+        side : str
+        qty : int
+        reference : float
+
+        Returns
+        -------
+        str
+            reject reason, None if the order passes.
+
+        """
+        state = self.state(symbol)
+        open_quantity = (state.open_buy if side == "Buy" else state.open_sell) + qty
+        max_position = self.limit(symbol, "max_position")
+        if (max_position is not None) and (open_quantity > max_position):
+            return "Position limit reached for the symbol"
+        max_exposure = self.limit(symbol, "max_exposure")
+        if max_exposure is not None:
+            if reference is None and price != "MKT":
+                reference = price
+            if (reference is not None) and (open_quantity * reference > max_exposure):
+                return "Exposure limit reached for the symbol"
+        return None
+
+    def check(self, symbol, price, side: str, qty: int, book=None) -> str:
+        """
+        All the checks for one cleaned order
+
+        Parameters
+        ----------
+        symbol : str
+        price : float or 'MKT'
+        side : str
+        qty : int
+        book : FullBook, optional
+            book of the symbol, used for the mid. The default is None.
+
+        Returns
+        -------
+        str
+            reject reason, None if the order passes.
+
+        """
+        reference = self.reference_price(symbol, book)
+        reason = self.check_price(symbol, price, qty, reference)
+        if reason is None:
+            reason = self.check_position(symbol, price, side, qty, reference)
+        return reason
+
+    def accept(self, symbol, side: str, qty: int):
+        """
+        Account for an accepted order
+
+        Parameters
+        ----------
+        symbol : str
+        side : str
+        qty : int
+
+        Returns
+        -------
+        None.
+
+        """
+        state = self.state(symbol)
+        if side == "Buy":
+            state.open_buy += qty
+        else:
+            state.open_sell += qty
+
+    def check_batch(self, df: pd.DataFrame, books: dict) -> pd.Series:
+        """
+        Vectorized price collars and maximum notional over a batch of orders,
+        against the reference prices at the start of the batch.
+        Rows that don't parse are left to the engine checks.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            orders in the engine input format.
+        books : dict
+            ticker -> FullBook.
+
+        Returns
+        -------
+        pd.Series
+            reject reason per row, None for the rows that pass.
+
+        """
+        reasons = pd.Series(np.full(len(df), None, dtype=object), index=df.index)
+        if len(df) == 0:
+            return reasons
+        symbol = df["Symbol"].astype(str)
+        is_mkt = df["Price"].astype(str) == "MKT"
+        price = pd.to_numeric(df["Price"].where(~is_mkt), errors="coerce").round(1)
+        qty = np.trunc(pd.to_numeric(df["OrderQuantity"], errors="coerce"))
+
+        # per symbol values computed once per symbol and broadcast to the rows
+        symbols = symbol.unique()
+        per_symbol = pd.DataFrame(
+            {
+                "reference": [self.reference_price(s, books.get(s)) for s in symbols],
+                "price_band": [self.limit(s, "price_band") for s in symbols],
+                "max_notional": [self.limit(s, "max_notional") for s in symbols],
+            },
+            index=symbols,
+            dtype=float,
+        )
+        reference = symbol.map(per_symbol["reference"])
+        band = symbol.map(per_symbol["price_band"])
+        max_notional = symbol.map(per_symbol["max_notional"])
+
+        # NaN comparisons are False so missing values never reject
+        notional = qty * price.where(~is_mkt, reference)
+        reasons[notional > max_notional] = "Order notional above the maximum notional"
+        outside = (price - reference).abs() > band * reference
+        reasons[outside] = "Price outside of the price band around the reference price"
+        return reasons
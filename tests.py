@@ -1,8 +1,16 @@
 import pandas as pd 
 import numpy as np
 import csv 
+import os
+import shutil
+import tempfile
 from matching_engine import MatchingEngine
 
+# the logs, binary files, spill files and sockets written by the cases go to a
+# temporary directory removed once every case passed
+test_dir = tempfile.mkdtemp()
+os.chdir(test_dir)
+
 #CASE 1 the orders are crossing the mid, mkt buy vs sell
 # one negative price order 
 d1 = pd.DataFrame(np.array([[1,'MSFT','MKT','Buy',-1],[2,'MSFT','MKT','Buy',100],[3,'MSFT',99,'Sell',90]]),columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
@@ -21,4 +29,512 @@ d4 = pd.DataFrame(np.array([[1,'MSFT',20,'Buy',-1],[2,'MSFT',99,'Sell',None]]),c
 for df in [d1,d2]:
     engine = MatchingEngine()
     engine.load(file_path=None,df=df)
+
+
+#CASE 3 binary order file, replaying it must log exactly what the DataFrame path logs
+from binary_orders import write_orders, read_orders
+
+engine = MatchingEngine()
+engine.load(file_path=None,df=d1)
+with open("Matching_Logs.csv") as f:
+    df_logs = f.read()
+write_orders("orders.bin", d1)
+symbols, records = read_orders("orders.bin")
+assert symbols == ['MSFT'] and len(records) == 3
+engine = MatchingEngine()
+engine.load_binary("orders.bin")
+with open("Matching_Logs.csv") as f:
+    assert f.read() == df_logs
+assert engine.books['MSFT'].bid.mkt_available.top.remaining == 10
+
+# sub-tick prices are rounded like the DataFrame path
+rng = np.random.default_rng(3)
+n = 3000
+d3b = pd.DataFrame({
+    'OrderID': np.arange(n),
+    'Symbol': 'MSFT',
+    'Price': np.where(rng.random(n) < 0.05, 'MKT', np.round(100 + rng.normal(0, 1, n), 2).astype(str)),
+    'Side': rng.choice(['Buy', 'Sell'], n),
+    'OrderQuantity': rng.integers(1, 100, n),
+})
+d3b.loc[0, 'Price'] = '100.45'
+replays = []
+for binary in (False, True):
+    events = []
+    engine = MatchingEngine(text_logs=False)
+    for register in (engine.on_ack, engine.on_reject, engine.on_fill):
+        register(events.append)
+    if binary:
+        write_orders("sub_tick.bin", d3b)
+        engine.load_binary("sub_tick.bin")
+    else:
+        engine.load(file_path=None,df=d3b.copy())
+    replays.append(events)
+assert replays[0] == replays[1] and replays[0][0].price == 100.5
+
+
+#CASE 4 columnar event sink, same events read back from every format
+from event_sink import ColumnarEventSink, read_events, pa
+
+sink = ColumnarEventSink()
+engine = MatchingEngine(sink=sink)
+engine.load(file_path=None,df=d1)
+for path, fmt in [("events.bin", "packed"), ("events.arrow", "arrow"), ("events.parquet", "parquet")]:
+    if fmt != "packed" and pa is None:
+        continue
+    sink.write(path, fmt=fmt)
+    events = read_events(path)
+    # the resting side fill is logged in Logs.csv, the sink keeps both sides
+    assert list(events["ActionType"]) == ["Reject", "Ack", "Ack", "Fill", "Fill"]
+    assert list(events["OrderId"]) == [1, 2, 3, 2, 3]
+    assert list(events["FillQuantity"][events["ActionType"] == "Fill"]) == [90, 90]
+    assert events["Reason"][0] == "OrderQuantity need to be strickly positive"
+    assert np.isnan(events["Price"][1]) and events["Price"][2] == 99.0
+
+
+#CASE 5 shared memory ring buffer, consumers see every event in sequence and detect overruns
+from ring_buffer import RingPublisher, RingConsumer
+
+publisher = RingPublisher(capacity=4)
+consumer = RingConsumer(publisher.name)
+engine = MatchingEngine(sink=publisher, text_logs=False)
+engine.load(file_path=None,df=d1)
+events = consumer.poll()
+assert [seq for seq, _ in events] == [2, 3, 4, 5] and consumer.overruns == 1
+assert [type(e).__name__ for _, e in events] == ["AckEvent", "AckEvent", "FillEvent", "FillEvent"]
+assert events[2][1].order_id == 2 and events[2][1].price is None and events[2][1].fill_quantity == 90
+late = RingConsumer(publisher.name, from_start=False)
+engine = MatchingEngine(sink=publisher, text_logs=False)
+engine.load(file_path=None,df=d2)
+assert [seq for seq, _ in late.poll()] == [6, 7] and late.overruns == 0
+
+# every engine reason fits, longer texts are cut on a character boundary and flagged
+from matching_engine import RejectEvent
+long_reason = "Can't convert ID to numeric value. Please use numeric vaues as engine use id to assess time priority"
+publisher.reject(RejectEvent(8, "MSFT", 1.0, "Buy", 1, long_reason))
+publisher.reject(RejectEvent(9, "a" + "\u00e9" * 8, 1.0, "Buy", 1, "\u00e9" * 60))
+(_, full), (_, cut) = late.poll()
+assert full.reason == long_reason and late.truncated == 1 and publisher.truncated == 1
+assert cut.symbol == "a" + "\u00e9" * 7 and cut.reason == "\u00e9" * 56
+consumer.close()
+late.close()
+publisher.close()
+
+
+#CASE 6 subscribers, a buy sweeping two of three ask levels with out of order ids at 110
+d6 = pd.DataFrame([[1,'MSFT',100,'Sell',100],[3,'MSFT',120,'Sell',100],[5,'MSFT',110,'Sell',30],[2,'MSFT',110,'Sell',20],[6,'MSFT',115,'Buy',150]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+fills, levels, acks = [], [], []
+engine = MatchingEngine(text_logs=False)
+engine.on_ack(acks.append)
+engine.on_fill(fills.append)
+engine.on_level_change(levels.append)
+engine.load(file_path=None,df=d6)
+assert len(acks) == 5
+assert [(f.order_id, f.fill_price, f.fill_quantity, f.resting) for f in fills] == [
+    (1, 115.0, 100, True), (6, 115.0, 100, False),
+    (2, 115.0, 20, True), (6, 115.0, 20, False),
+    (5, 115.0, 30, True), (6, 115.0, 30, False),
+]
+assert levels[3] == ("MSFT", "Sell", 110.0, 50)
+assert [(l.price, l.quantity) for l in levels[4:]] == [(100.0, 0), (110.0, 30), (110.0, 0)]
+assert engine.books['MSFT'].ask.extreme_finder(True).price == 120.0
+
+
+#CASE 7 aggregated sweeps, a MKT buy eating the whole ask side then resting in the mkt queue
+d7 = pd.DataFrame([[1,'MSFT',100,'Sell',10],[2,'MSFT',101,'Sell',10],[3,'MSFT',102,'Sell',10],[4,'MSFT','MKT','Buy',50],[5,'MSFT',103,'Sell',5]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+fills, sweeps = [], []
+engine = MatchingEngine(aggregate_sweeps=True)
+engine.on_fill(fills.append)
+engine.on_sweep(sweeps.append)
+engine.load(file_path=None,df=d7)
+assert [(f.order_id, f.fill_price, f.resting) for f in fills] == [(1, 100.0, True), (2, 101.0, True), (3, 102.0, True), (4, 103.0, True)]
+assert sweeps[0] == (4, 'MSFT', None, 'Buy', 50, 30, 101.0, 3, 102.0)
+assert sweeps[1] == (5, 'MSFT', 103.0, 'Sell', 5, 5, 103.0, 1, 103.0)
+assert engine.books['MSFT'].bid.mkt_available.top.remaining == 15
+csv_logs = pd.read_csv("Matching_Logs.csv")
+assert list(csv_logs["ActionType"]) == ["Ack"] * 4 + ["SweepFill", "Ack", "SweepFill"]
+
+# the columnar sink and the ring buffer keep the sweeps
+sink, publisher = ColumnarEventSink(), RingPublisher(capacity=16)
+consumer = RingConsumer(publisher.name)
+sweep_engine = MatchingEngine(sink=sink, text_logs=False, aggregate_sweeps=True)
+sweep_engine.add_sink(publisher)
+sweep_engine.load(file_path=None,df=d7)
+sink.write("sweeps.bin", fmt="packed")
+events = read_events("sweeps.bin")
+events = events[events["ActionType"] == "SweepFill"]
+sweep_logs = csv_logs[csv_logs["ActionType"] == "SweepFill"]
+assert list(events["Reason"]) == list(sweep_logs["Reason"]) and list(events["FillQuantity"]) == list(sweep_logs["FillQuantity"])
+assert [e for _, e in consumer.poll() if type(e).__name__ == "SweepEvent"] == sweeps
+consumer.close()
+publisher.close()
+
+
+#CASE 8 trade statistics, the fills of CASE 7 and bars driven by a fake clock
+stats = engine.trade_stats()
+assert stats["symbol"][0] == 'MSFT' and stats["last_price"][0] == 103.0
+assert stats["volume"][0] == 35 and stats["trades"][0] == 4
+assert abs(stats["vwap"][0] - (100 * 10 + 101 * 10 + 102 * 10 + 103 * 5) / 35) < 1e-9
+
+from matching_engine import TradeStats
+now = [0.0]
+trade_stats = TradeStats(bar_interval=60, clock=lambda: now[0])
+for t, price, qty in [(1, 100, 10), (30, 102, 5), (59, 99, 5), (61, 101, 20), (200, 100, 1)]:
+    now[0] = t
+    trade_stats.update(price, qty)
+bars = trade_stats.to_bars()
+assert bars.tolist() == [(0.0, 100, 102, 99, 99, 20), (60.0, 101, 101, 101, 101, 20), (180.0, 100, 100, 100, 100, 1)]
+assert trade_stats.rolling_volume(150) == 21 and trade_stats.vwap == (1000 + 510 + 495 + 2020 + 100) / 41
+
+
+#CASE 9 top of book history of CASE 6, with a tiny buffer spilling to disk
+engine = MatchingEngine(text_logs=False)
+engine.record_top_of_book(capacity=1, max_capacity=2, spill_dir=".")
+engine.load(file_path=None,df=d6)
+recorder = engine.books['MSFT'].recorder
+assert recorder.spilled == 4 and len(recorder) == 5
+history = recorder.to_array()
+assert list(history["order_id"]) == [1, 3, 5, 2, 6]
+assert list(history["ask"]) == [100, 100, 100, 100, 120] and list(history["ask_size"]) == [100, 100, 100, 100, 100]
+assert np.isnan(history["bid"]).all() and (history["bid_size"] == 0).all()
+assert np.isnan(history["last"][:4]).all() and history["last"][4] == 115
+
+# the spill directory is created and the tickers are made safe file names
+engine = MatchingEngine(text_logs=False)
+engine.record_top_of_book(capacity=1, max_capacity=1, spill_dir="tob_spill")
+engine.load(file_path=None,df=pd.DataFrame([[1,'BRK/B',100,'Buy',1],[2,'BRK/B',101,'Buy',1]],columns=['OrderID','Symbol','Price','Side','OrderQuantity']))
+assert os.listdir("tob_spill") == ["BRK%2FB.tob"] and list(engine.books['BRK/B'].recorder.to_array()["order_id"]) == [1, 2]
+
+
+#CASE 10 pre-trade risk, the first batch sets the reference price of the second one
+from risk import PreTradeRisk
+
+d10a = pd.DataFrame([[1,'MSFT',100,'Sell',100],[2,'MSFT',100,'Buy',50]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+d10b = pd.DataFrame([[4,'MSFT',150,'Buy',10],[5,'MSFT',105,'Buy',600],[6,'MSFT','MKT','Sell',200],[7,'MSFT',95,'Sell',100],[8,'AAPL',1000,'Buy',100]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+rejects = []
+risk = PreTradeRisk(price_band=0.1, max_notional=50000, max_position=150, symbol_limits={'AAPL': {'max_notional': None}})
+engine = MatchingEngine(text_logs=False, risk=risk)
+engine.on_reject(rejects.append)
+engine.load(file_path=None,df=d10a)
+assert rejects == [] and risk.states['MSFT'].reference == 100 and risk.states['MSFT'].open_sell == 50
+engine.load(file_path=None,df=d10b)
+assert [(r.order_id, r.reason) for r in rejects] == [
+    (4, "Price outside of the price band around the reference price"),
+    (5, "Order notional above the maximum notional"),
+    (6, "Position limit reached for the symbol"),
+]
+assert risk.states['MSFT'].open_sell == 150 and risk.states['AAPL'].open_buy == 100
+assert risk.check('MSFT', 'MKT', 'Sell', 1) == "Position limit reached for the symbol"
+
+# fat finger in the batch whose first trade sets the reference, same rejects as the binary path
+d10c = pd.DataFrame([[1,'MSFT',100,'Sell',10],[2,'MSFT',100,'Buy',10],[3,'MSFT',101,'Sell',10],[4,'MSFT',1000,'Buy',10]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+write_orders("fat_finger.bin", d10c)
+for replay_batch in (lambda e: e.load(file_path=None, df=d10c), lambda e: e.load_binary("fat_finger.bin")):
+    rejects = []
+    engine = MatchingEngine(text_logs=False, risk=PreTradeRisk(price_band=0.1))
+    engine.on_reject(rejects.append)
+    replay_batch(engine)
+    assert [(r.order_id, r.reason) for r in rejects] == [(4, "Price outside of the price band around the reference price")]
+    assert engine.books['MSFT'].ask.resting_orders == 1
+
+
+#CASE 11 duplicate OrderIDs, an id rejected for another reason can still be used
+from order_ids import OrderIdIndex
+
+d11 = pd.DataFrame([[1,'MSFT',100,'Sell',10],[2,'MSFT',100,'Sell',-5],[1,'MSFT',101,'Sell',10],[2,'MSFT',101,'Sell',10],[2,'AAPL',50,'Buy',10]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+rejects = []
+engine = MatchingEngine(text_logs=False)
+engine.on_reject(rejects.append)
+engine.load(file_path=None,df=d11)
+assert [(r.order_id, r.reason) for r in rejects] == [
+    (2, "OrderQuantity need to be strickly positive"),
+    (1, "Duplicate OrderID, already used by an accepted order"),
+    (2, "Duplicate OrderID, already used by an accepted order"),
+]
+assert len(engine.order_ids) == 2 and list(engine.order_ids.starts) == [1]
+
+rng = np.random.default_rng(11)
+index, seen = OrderIdIndex(), set()
+for order_id in np.concatenate([np.arange(1000), rng.integers(0, 3000, 2000)]).tolist():
+    assert index.add(order_id) == (order_id not in seen)
+    seen.add(order_id)
+assert len(index) == len(seen) and all((i in index) == (i in seen) for i in range(-1, 3001))
+
+# ids outside int64 are rejected without stopping the batch, the index takes any int
+d11b = pd.DataFrame([[2**63,'MSFT',100,'Sell',10],[-2**63-1,'MSFT',100,'Sell',10],[2**63-1,'MSFT',100,'Sell',10]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+rejects, sink = [], ColumnarEventSink()
+engine = MatchingEngine(text_logs=False, sink=sink)
+engine.on_reject(rejects.append)
+engine.load(file_path=None,df=d11b)
+assert [r.reason for r in rejects] == ["OrderID must fit in a signed 64 bit integer"] * 2
+assert 2**63-1 in engine.order_ids and list(sink.columns["order_id"]) == [-1, -1, 2**63-1]
+for order_id in [2**63-1, 2**63, -2**63-1, 2**70]:
+    assert index.add(order_id) and order_id in index and not index.add(order_id)
+assert len(index) == len(seen) + 4
+assert index.starts[0] == 0 and index.ends[0] >= 1000
+
+
+#CASE 12 idle book eviction, one empty book kept alive
+d12a = pd.DataFrame([[1,'AAPL',100,'Buy',10],[2,'AAPL',100,'Sell',10],[3,'IBM',50,'Sell',5],[4,'GOOG',10,'Buy',1],[5,'GOOG',10,'Sell',1],[6,'IBM',50,'Buy',5]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+d12b = pd.DataFrame([[7,'AAPL',101,'Buy',3]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+engine = MatchingEngine(text_logs=False, max_idle_books=1)
+engine.load(file_path=None,df=d12a)
+assert list(engine.books) == ['IBM'] and list(engine.idle_books) == ['IBM']
+assert engine.book_counts() == {"live": 1, "idle": 1, "evicted": 2, "evictions": 2, "rematerializations": 0}
+assert sorted(engine.trade_stats()["symbol"]) == ['AAPL', 'GOOG', 'IBM']
+engine.load(file_path=None,df=d12b)
+assert engine.book_counts() == {"live": 2, "idle": 1, "evicted": 1, "evictions": 2, "rematerializations": 1}
+assert engine.books['AAPL'].trade_stats.volume == 10 and engine.books['AAPL'].bid.best_level().price == 101
+
+# the spilled top of book history survives the eviction, and books without data are only counted
+engine = MatchingEngine(text_logs=False, max_idle_books=0)
+engine.record_top_of_book(capacity=1, max_capacity=1, spill_dir=".")
+engine.load(file_path=None,df=d12a)
+engine.load(file_path=None,df=d12b)
+recorder = engine.books['AAPL'].recorder
+assert recorder.spilled > 0 and list(recorder.to_array()["order_id"]) == [1, 2, 7]
+engine = MatchingEngine(text_logs=False)
+engine.add_book('IBM')
+engine.evict_book('IBM')
+assert engine.evicted == {} and engine.book_counts()["evictions"] == 1
+
+
+#CASE 13 book stats, counters of CASE 6 and a random stream checked against a full walk
+engine = MatchingEngine(text_logs=False)
+engine.load(file_path=None,df=d6)
+ask = engine.books['MSFT'].stats()["ask"]
+assert (ask["resting_orders"], ask["levels"], ask["live_levels"], ask["empty_levels"]) == (1, 3, 1, 2)
+assert ask["height"] == 3 and ask["global_quantity"] == 100 and ask["mkt_orders"] == 0
+assert engine.books['MSFT'].stats(verify=True)["bid"]["mismatches"] == []
+
+rng = np.random.default_rng(13)
+n = 2000
+d13 = pd.DataFrame({
+    'OrderID': np.arange(n),
+    'Symbol': rng.choice(['MSFT', 'AAPL'], n),
+    'Price': np.where(rng.random(n) < 0.1, 'MKT', rng.integers(90, 110, n).astype(str)),
+    'Side': rng.choice(['Buy', 'Sell'], n),
+    'OrderQuantity': rng.integers(1, 50, n),
+})
+engine = MatchingEngine(text_logs=False)
+engine.load(file_path=None,df=d13)
+stats = engine.stats(verify=True)
+assert stats["mismatches"] == {} and stats["books"]["live"] == 2 and stats["bytes"] > 0
+assert stats["resting_orders"] == sum(b.bid.resting_orders + b.ask.resting_orders for b in engine.books.values())
+
+
+#CASE 14 parallel replay of a directory of days, each day logging in its own directory
+import os
+from replay import replay
+
+os.makedirs("replay_in", exist_ok=True)
+d1.to_csv("replay_in/day1.csv", sep=";", index=False)
+d6.to_csv("replay_in/day2.csv", sep=";", index=False)
+write_orders("replay_in/day3.bin", d7)
+summary = replay("replay_in", "replay_out", workers=2)
+assert list(summary["day"]) == ["day1", "day2", "day3"]
+assert list(summary["orders"]) == [3, 5, 5] and list(summary["rejects"]) == [1, 0, 0]
+assert list(summary["fills"]) == [1, 3, 4] and list(summary["filled_quantity"]) == [90, 150, 35]
+assert list(pd.read_csv("replay_out/day2/Matching_Logs.csv")["OrderId"]) == [1, 3, 5, 2, 6, 6, 6, 6]
+assert os.path.exists("replay_out/summary.csv")
+
+# replaying again into the same directory gives the same logs
+replay("replay_in", "replay_out", workers=2)
+resting = pd.read_csv("replay_out/day2/Logs.csv")
+assert list(resting["ActionType"]) == ["Fill"] * 3 and list(resting["OrderId"]) == [1, 2, 5]
+write_orders("replay_in/day1.bin", d1)
+try:
+    replay("replay_in", "replay_out", workers=2)
+    raise AssertionError("two files for day1")
+except Exception as e:
+    assert str(e) == "several order files for the days day1"
+os.remove("replay_in/day1.bin")
+
+
+#CASE 15 concurrent submission, 4 gateway threads on 4 matching threads, each symbol
+# must get exactly the events of a sequential run, numbered in order
+import threading
+from concurrent_engine import ConcurrentEngine
+
+rng = np.random.default_rng(15)
+symbols = ['S%d' % i for i in range(8)]
+streams = {s: [] for s in symbols}
+for order_id in range(4000):
+    symbol = symbols[rng.integers(len(symbols))]
+    price = 'MKT' if rng.random() < 0.05 else float(rng.integers(95, 105))
+    streams[symbol].append((order_id, symbol, price, ['Buy', 'Sell'][rng.integers(2)], int(rng.integers(1, 100))))
+streams['S0'].append((streams['S0'][0][0], 'S0', 100.0, 'Buy', 10))  # duplicate id
+# an id rejected by the checks can still be used, like in the sequential engine
+streams['S1'] += [(5000, 'S1', 100.0, 'Buy', -1), (5000, 'S1', 100.0, 'Buy', 10)]
+
+expected = {s: [] for s in symbols}
+engine = MatchingEngine(text_logs=False)
+for register in (engine.on_ack, engine.on_reject, engine.on_fill):
+    register(lambda e: expected[e.symbol].append(e))
+for symbol in symbols:
+    engine.load(file_path=None, df=pd.DataFrame(streams[symbol], columns=['OrderID','Symbol','Price','Side','OrderQuantity']))
+
+received = {s: [] for s in symbols}
+with ConcurrentEngine(threads=4) as concurrent:
+    concurrent.on_event(lambda e: received[e.symbol].append(e))
+    def gateway(gateway_symbols):
+        for symbol in gateway_symbols:
+            for order in streams[symbol]:
+                concurrent.submit(*order)
+    gateways = [threading.Thread(target=gateway, args=(symbols[i::4],)) for i in range(4)]
+    for thread in gateways:
+        thread.start()
+    for thread in gateways:
+        thread.join()
+    concurrent.flush()
+for symbol in symbols:
+    assert [e.seq for e in received[symbol]] == list(range(len(expected[symbol])))
+    assert [e.event for e in received[symbol]] == expected[symbol]
+assert received['S0'][-1].event.reason == "Duplicate OrderID, already used by an accepted order"
+
+
+#CASE 16 asyncio gateway, two clients on TCP and one on a Unix socket
+import asyncio
+from gateway import OrderGateway
+
+async def client_session(open_connection, lines, expected):
+    reader, writer = await open_connection
+    for line in lines:
+        writer.write((line + "\n").encode())
+    await writer.drain()
+    received = []
+    while len(received) < expected:
+        received.append((await reader.readline()).decode().strip())
+    writer.close()
+    return received
+
+async def gateway_session():
+    gateway = OrderGateway(max_queue=8)
+    server = await gateway.start_tcp()
+    unix_server = await gateway.start_unix("gateway.sock")
+    host, port = server.sockets[0].getsockname()[:2]
+    seller = await client_session(asyncio.open_connection(host, port), ["1;MSFT;100;Sell;10", "2;MSFT;101;Sell;10"], 2)
+    buyer, other = await asyncio.gather(
+        client_session(asyncio.open_connection(host, port), ["3;MSFT;101;Buy;15", "4;MSFT;101;Buy;-1", "bad line"], 5),
+        client_session(asyncio.open_unix_connection("gateway.sock"), ["5;AAPL;MKT;Buy;5", "bad", "6;AAPL;MKT;Buy;1"], 3),
+    )
+    await gateway.wait_clients()
+    server.close()
+    unix_server.close()
+    return gateway, seller, buyer, other
+
+gateway, seller, buyer, other = asyncio.run(gateway_session())
+assert seller == ["Ack;1;MSFT;100.0;Sell;10", "Ack;2;MSFT;101.0;Sell;10"]
+assert buyer == [
+    "Ack;3;MSFT;101.0;Buy;15",
+    "Fill;3;MSFT;101.0;Buy;15;101.0;10",
+    "Fill;3;MSFT;101.0;Buy;15;101.0;5",
+    "Reject;4;MSFT;101.0;Buy;-1;;;OrderQuantity need to be strickly positive",
+    "Reject;;;;;;;;Malformed order line, expected OrderID;Symbol;Price;Side;OrderQuantity",
+]
+# a malformed line is answered in its place
+assert other == ["Ack;5;AAPL;MKT;Buy;5", "Reject;;;;;;;;Malformed order line, expected OrderID;Symbol;Price;Side;OrderQuantity", "Ack;6;AAPL;MKT;Buy;1"]
+assert gateway.engine.books['MSFT'].ask.resting_orders == 1 and set(gateway.owners) == {2, 5, 6}
+
+async def sweep_session():
+    gateway = OrderGateway(MatchingEngine(text_logs=False, aggregate_sweeps=True))
+    server = await gateway.start_tcp()
+    host, port = server.sockets[0].getsockname()[:2]
+    await client_session(asyncio.open_connection(host, port), ["1;MSFT;100;Sell;10", "2;MSFT;101;Sell;10"], 2)
+    received = await client_session(asyncio.open_connection(host, port), ["3;MSFT;MKT;Buy;15"], 2)
+    await gateway.wait_clients()
+    server.close()
+    return gateway, received
+
+gateway, received = asyncio.run(sweep_session())
+assert received == ["Ack;3;MSFT;MKT;Buy;15", "SweepFill;3;MSFT;MKT;Buy;15;100.33333333333333;15;levels: 2, worst price: 101.0"]
+assert set(gateway.owners) == {2}
+
+# a client letting the fills of its resting orders pile up is disconnected, the
+# aggressor only gets its ack and sweep
+async def slow_session():
+    gateway = OrderGateway(MatchingEngine(text_logs=False, aggregate_sweeps=True), max_queue=6)
+    server = await gateway.start_tcp()
+    host, port = server.sockets[0].getsockname()[:2]
+    reader, writer = await asyncio.open_connection(host, port)
+    received = []
+    for i in range(7):
+        writer.write(("%d;MSFT;100;Sell;1\n" % i).encode())
+        received.append((await reader.readline()).decode().strip())
+    aggressor = await client_session(asyncio.open_connection(host, port), ["7;MSFT;100;Buy;7"], 2)
+    try:
+        received.append(await reader.read())
+    except ConnectionError:
+        pass
+    writer.close()
+    await gateway.wait_clients()
+    server.close()
+    return gateway, received, aggressor
+
+gateway, received, aggressor = asyncio.run(slow_session())
+assert received[:7] == ["Ack;%d;MSFT;100.0;Sell;1" % i for i in range(7)] and received[7:] in ([], [b""])
+assert aggressor == ["Ack;7;MSFT;100.0;Buy;7", "SweepFill;7;MSFT;100.0;Buy;7;100.0;7;levels: 1, worst price: 100.0"] and not gateway.handlers
+
+
+#CASE 17 market orders queued on both sides crossed in bulk by a limit order
+d17 = pd.DataFrame([[1,'MSFT','MKT','Buy',5],[2,'MSFT','MKT','Sell',4],[3,'MSFT','MKT','Buy',7],[4,'MSFT','MKT','Sell',4],[5,'MSFT','MKT','Buy',3],[6,'MSFT','MKT','Sell',4],[7,'MSFT','MKT','Sell',10],[8,'MSFT',100,'Buy',1]],columns=['OrderID','Symbol','Price','Side','OrderQuantity'])
+fills = []
+engine = MatchingEngine(text_logs=False)
+engine.on_fill(fills.append)
+engine.load(file_path=None,df=d17)
+assert [(f.order_id, f.fill_quantity) for f in fills if not f.resting] == [(2, 4), (4, 1), (4, 3), (6, 4), (7, 3), (8, 1)]
+assert [f.order_id for f in fills if f.resting] == [1, 1, 3, 3, 5, 7]
+book = engine.books['MSFT']
+assert book.ask.mkt_available.top.id == 7 and book.ask.mkt_available.total_quantity == 6
+assert book.bid.mkt_available.top is None and book.stats(verify=True)["ask"]["mismatches"] == []
+
+# empty market queues crossing nothing don't report level changes
+levels = []
+engine = MatchingEngine(text_logs=False)
+engine.on_level_change(levels.append)
+engine.load(file_path=None,df=pd.DataFrame([[1,'MSFT','MKT','Buy',5],[2,'MSFT','MKT','Sell',5],[3,'MSFT',100,'Buy',1],[4,'MSFT',101,'Sell',1]],columns=['OrderID','Symbol','Price','Side','OrderQuantity']))
+assert [(l.side, l.price, l.quantity) for l in levels] == [
+    ('Buy', None, 5), ('Sell', None, 5), ('Sell', None, 0), ('Buy', None, 0), ('Buy', 100.0, 1), ('Sell', 101.0, 1),
+]
+
+
+#CASE 18 differential harness, the engine against itself and against a book losing
+# the quantity above 50 of the limit orders it logs
+from differential import compare
+from matching_engine import FullBook
+
+summary, divergences = compare(MatchingEngine, orders=300, seeds=(0,), repeat=1)
+assert summary["match"].all() and divergences == [] and len(summary) == 5
+
+class CappedBook(FullBook):
+    def log_limit_order(self, limit_order):
+        limit_order.remaining = min(limit_order.remaining, 50)
+        super().log_limit_order(limit_order)
+
+class CappedEngine(MatchingEngine):
+    book_class = CappedBook
+
+summary, divergences = compare(CappedEngine, scenarios=["limit"], orders=300, seeds=(0,), repeat=1)
+assert not summary["match"][0] and len(divergences) == 1
+reproducer = divergences[0].reproducer
+assert len(reproducer) == 1 and reproducer["OrderQuantity"][0] > 50
+assert divergences[0].expected.quantity > 50 and divergences[0].received.quantity == 50
+
+# the final books are compared through their snapshot, a failing snapshot is a divergence
+engine = MatchingEngine(text_logs=False)
+engine.load(file_path=None,df=d6)
+assert engine.books['MSFT'].snapshot() == {"Buy": ((), ()), "Sell": (((120.0, ((3, 100),)),), ())}
+
+class NoSnapshotBook(FullBook):
+    def snapshot(self):
+        raise Exception("no snapshot")
+
+class NoSnapshotEngine(MatchingEngine):
+    book_class = NoSnapshotBook
+
+summary, divergences = compare(NoSnapshotEngine, scenarios=["limit"], orders=50, seeds=(0,), repeat=1, reproduce=False)
+assert divergences[0].received == ("Exception", "Exception('no snapshot')")
+
+os.chdir(os.path.dirname(test_dir))
+shutil.rmtree(test_dir)
 print("ok")
\ No newline at end of file
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Top of book history recorder
+
+Best bid, best ask, their sizes and the last trade are captured after every order
+processed by a book into a preallocated numpy structured array, which grows by
+doubling and spills to disk in chunks once it reaches its maximum size.
+"""
+
+import numpy as np
+
+TOB_DTYPE = np.dtype(
+    [
+        ("order_id", "i8"),
+        ("bid", "f8"),
+        ("bid_size", "i8"),
+        ("ask", "f8"),
+        ("ask_size", "i8"),
+        ("last", "f8"),
+    ]
+)
+
+
+class TopOfBookRecorder:
+    """
+    TAQ-style series of one book, prices are NaN when a side is empty or nothing
+    traded yet
+    """
+
+    def __init__(
+        self,
+        capacity: int = 4096,
+        max_capacity: int = 1 << 20,
+        spill_path: str = None,
+    ):
+        """
+
+        Parameters
+        ----------
+        capacity : int, optional
+            initial number of preallocated rows. The default is 4096.
+        max_capacity : int, optional
+            size after which the rows are spilled to spill_path. The default is 1 << 20.
+        spill_path : str, optional
+            file receiving the spilled chunks (raw TOB_DTYPE rows), it is truncated.
+            The default is None, the buffer then keeps growing.
+
+        Returns
+        -------
+        None.
+
+        """
+        if capacity <= 0:
+            raise Exception("capacity must be strictly positive")
+        self.data = np.empty(capacity, dtype=TOB_DTYPE)
+        self.size = 0
+        self.max_capacity = max(capacity, max_capacity)
+        self.spill_path = spill_path
+        self.spilled = 0  # number of rows on disk
+        if spill_path is not None:
+            open(spill_path, "wb").close()
+
+    def __len__(self):
+        return self.spilled + self.size
+
+    def record(self, order_id, bid, bid_size, ask, ask_size, last):
+        """
+        Append one row
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.size == len(self.data):
+            self.make_room()
+        self.data[self.size] = (order_id, bid, bid_size, ask, ask_size, last)
+        self.size += 1
+
+    def make_room(self):
+        """
+        Double the buffer, or spill it to disk once it reached max_capacity
+
+        Returns
+        -------
+        None.
+
+        """
+        if (len(self.data) >= self.max_capacity) and (self.spill_path is not None):
+            self.spill()
+        else:
+            data = np.empty(2 * len(self.data), dtype=TOB_DTYPE)
+            data[: self.size] = self.data[: self.size]
+            self.data = data
+
+    def spill(self):
+        """
+        Append the buffered rows to spill_path and empty the buffer
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.spill_path is None:
+            raise Exception("no spill_path to spill the rows to")
+        with open(self.spill_path, "ab") as f:
+            self.data[: self.size].tofile(f)
+        self.spilled += self.size
+        self.size = 0
+
+    def to_array(self) -> np.ndarray:
+        """
+        Whole history, spilled rows included
+
+        Returns
+        -------
+        np.ndarray
+            structured array with TOB_DTYPE.
+
+        """
+        if self.spilled == 0:
+            return self.data[: self.size].copy()
+        return np.concatenate(
+            [np.fromfile(self.spill_path, dtype=TOB_DTYPE), self.data[: self.size]]
+        )